@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Measure how many images per second the training input pipelines deliver,
+on a synthetic tub of random camera frames.
+
+Usage:
+    python benchmark.py [--records 2000] [--batches 50] [--batch-size 128] [--fmt json|log]
+
+Compares the python batch generator and the tf.data pipeline of
+parts/dataset.py.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from parts.datastore import Tub, TubGroup
+from parts.dataset import make_dataset
+
+X_KEYS = ['cam/image_array']
+Y_KEYS = ['user/angle', 'user/throttle']
+
+
+def make_synthetic_tub(path, num_records, fmt, shape=(120, 160, 3)):
+    tub = Tub(path, inputs=X_KEYS + Y_KEYS + ['user/mode'],
+              types=['image_array', 'float', 'float', 'str'], fmt=fmt)
+    # smooth frames compress like camera images, pure noise would not
+    base = np.random.randint(0, 255, size=(shape[0] // 8, shape[1] // 8, shape[2]), dtype=np.uint8)
+    base = base.repeat(8, axis=0).repeat(8, axis=1)
+    for i in range(num_records):
+        img = np.roll(base, i, axis=1)
+        tub.put_record({'cam/image_array': img,
+                        'user/angle': float(np.sin(i / 10)),
+                        'user/throttle': 0.5,
+                        'user/mode': 'user'})
+    tub.shutdown()
+
+
+def measure(batches, num_batches, batch_size):
+    next(batches)  # startup is not part of the rate
+    start = time.time()
+    for _ in range(num_batches):
+        next(batches)
+    return num_batches * batch_size / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=2000)
+    parser.add_argument('--batches', type=int, default=50)
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--fmt', default='log')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        make_synthetic_tub(os.path.join(root, 'tub_bench'), args.records, args.fmt)
+        tubgroup = TubGroup(root)
+
+        results = {}
+        gen = tubgroup.get_train_gen(X_KEYS, Y_KEYS, batch_size=args.batch_size)
+        results['generator'] = measure(gen, args.batches, args.batch_size)
+        gen.close()
+
+        ds = make_dataset(tubgroup, X_KEYS, Y_KEYS, batch_size=args.batch_size)
+        results['tf.data'] = measure(iter(ds), args.batches, args.batch_size)
+
+        print('{} records ({} tub), {} batches of {}'.format(args.records, args.fmt, args.batches,
+                                                             args.batch_size))
+        for name, rate in results.items():
+            print('{:<32} {:>10.0f} images/s'.format(name, rate))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
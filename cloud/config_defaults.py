@@ -31,3 +31,11 @@ CAMERA_FRAMERATE = DRIVE_LOOP_HZ
 BATCH_SIZE = 128
 TRAIN_TEST_SPLIT = 0.8
 EPOCHS = 50
+FRAME_CACHE = False  # decode each tub once into a memory-mapped array reused by every epoch
+FRAME_CACHE_PATH = "~/mycar/frame_cache"
+FRAME_CACHE_BUDGET_GB = 20
+TF_DATA = False  # feed keras from a tf.data pipeline instead of the python generators
+TF_DATA_CACHE = None  # None: decode every epoch, '': keep decoded records in memory, or a cache file path
+TFLITE_EXPORT = True  # also write model/model.tflite for the car
+TFLITE_QUANTIZE = False  # int8 post-training quantization of the tflite model
+TFLITE_CALIBRATION_FRAMES = 200  # tub frames used to calibrate the quantization
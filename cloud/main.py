@@ -2,7 +2,9 @@
 import os
 from config import load_config
 from parts.datastore import TubGroup
-from parts.keras import KerasLinear
+from parts.keras import KerasLinear, export_tflite, TFLITE_FILE
+from parts.framecache import FrameCache
+from parts.dataset import make_train_val_datasets
 import tensorflow as tf
 from flask import Flask, request
 from flask import jsonify
@@ -10,6 +12,9 @@ from celery import Celery
 import json
 import re
 import redis
+from log import get_logger
+
+logger = get_logger(__name__)
 
 app = Flask(__name__)
 app.config['CELERY_BROKER_URL'] = os.environ['BROKER_URL']
@@ -27,7 +32,9 @@ def get_redis_connect(address):
 
 
 @celery.task(bind=True)
-def train_model(self, tub_path, model_path, epochs, batch_size, train_test_split, ):
+def train_model(self, tub_path, model_path, epochs, batch_size, train_test_split, frame_cache_path=None,
+                frame_cache_budget=0, use_tf_data=False, tf_data_cache=None, tflite_export=False,
+                tflite_quantize=False, calibration_frames=200):
     gpu_devices = tf.config.experimental.list_physical_devices('GPU')
     for device in gpu_devices:
         tf.config.experimental.set_memory_growth(device, True)
@@ -42,8 +49,18 @@ def train_model(self, tub_path, model_path, epochs, batch_size, train_test_split
 
     tub_path = os.path.expanduser(tub_path)
     tubgroup = TubGroup(tub_path)
-    train_gen, val_gen = tubgroup.get_train_val_gen(X_keys, Y_keys, batch_size=batch_size,
-                                                    train_frac=train_test_split)
+    if use_tf_data:
+        # tf.data reads and decodes on its own thread pool
+        if tf_data_cache:
+            tf_data_cache = os.path.expanduser(tf_data_cache)
+        train_gen, val_gen = make_train_val_datasets(tubgroup, X_keys, Y_keys, batch_size=batch_size,
+                                                     train_frac=train_test_split, cache=tf_data_cache)
+    else:
+        if frame_cache_path:
+            # decode every image once, epochs then read them from memory maps
+            tubgroup.materialize(FrameCache(frame_cache_path, frame_cache_budget), key=X_keys[0])
+        train_gen, val_gen = tubgroup.get_train_val_gen(X_keys, Y_keys, batch_size=batch_size,
+                                                        train_frac=train_test_split)
 
     model_path = os.path.expanduser(model_path)
     total_records = len(tubgroup.df)
@@ -55,8 +72,23 @@ def train_model(self, tub_path, model_path, epochs, batch_size, train_test_split
     r.hset(task_id, key="epoch", value=0)
     r.hset(task_id, key="loss", value=1)
     self.update_state(state='PROGRESS')
-    kl.train(train_gen, val_gen, saved_model_path=model_path, steps=steps_per_epoch, train_split=train_test_split,
-             epochs=epochs, redis_connect=r, task_id=task_id)
+    try:
+        kl.train(train_gen, val_gen, saved_model_path=model_path, steps=steps_per_epoch,
+                 train_split=train_test_split, epochs=epochs, redis_connect=r, task_id=task_id)
+    finally:
+        if not use_tf_data:
+            train_gen.close()
+            val_gen.close()
+
+    if tflite_export:
+        # the checkpoint holds the best epoch, export that one
+        kl.load(model_path)
+        calibration_images = None
+        if tflite_quantize:
+            paths = tubgroup.df[X_keys[0]].sample(n=min(calibration_frames, total_records), random_state=200)
+            calibration_images = tubgroup.read_images(paths.to_numpy())
+        tflite_path = export_tflite(kl.model, os.path.join(model_path, TFLITE_FILE), calibration_images)
+        logger.info('Exported tflite model: {}'.format(tflite_path))
     self.update_state(state='SUCCESS')
     r.close()
 
@@ -66,7 +98,10 @@ def train():
     cfg = load_config()
     data_path = request.form['data_path']
     models_path = os.path.join(data_path, 'model')
-    task = train_model.delay(data_path, models_path, cfg.EPOCHS, cfg.BATCH_SIZE, cfg.TRAIN_TEST_SPLIT)
+    frame_cache_path = cfg.FRAME_CACHE_PATH if cfg.FRAME_CACHE else None
+    task = train_model.delay(data_path, models_path, cfg.EPOCHS, cfg.BATCH_SIZE, cfg.TRAIN_TEST_SPLIT,
+                             frame_cache_path, cfg.FRAME_CACHE_BUDGET_GB * 2 ** 30, cfg.TF_DATA, cfg.TF_DATA_CACHE,
+                             cfg.TFLITE_EXPORT, cfg.TFLITE_QUANTIZE, cfg.TFLITE_CALIBRATION_FRAMES)
     return jsonify({'task_id': task.id})
 
 
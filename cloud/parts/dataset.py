@@ -0,0 +1,152 @@
+"""
+dataset.py
+
+tf.data input pipelines over the records of a Tub or TubGroup, an
+alternative to the python generators of Tub.get_train_gen that reads and
+decodes images on the tf.data thread pool.
+
+"""
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from log import get_logger
+from parts.tublog import open_blob, is_blob_ref
+
+logger = get_logger(__name__)
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+
+def _read_blob(val):
+    """ Runs on the tf.data threads: the bytes of an image file or a blob reference. """
+    f = open_blob(val.decode())
+    if isinstance(f, str):
+        with open(f, 'rb') as fp:
+            return fp.read()
+    return f.read()
+
+
+def split_by_tub(tub, df):
+    """
+    Splits the rows of df, a subset of tub.get_df(), into one DataFrame per
+    tub they were read from. A Tub is its own only tub.
+    """
+    tubs = getattr(tub, 'tubs', [tub])
+    labels = df.index.to_numpy()
+    parts = []
+    start = 0
+    # the rows of each tub follow each other in the joined DataFrame
+    for t in tubs:
+        end = start + len(t.get_df())
+        in_tub = (labels >= start) & (labels < end)
+        if in_tub.any():
+            parts.append(df[in_tub])
+        start = end
+    return parts
+
+
+def make_dataset(tub, X_keys, Y_keys, df=None, batch_size=128, shuffle=True, cache=None,
+                 shuffle_buffer=10000):
+    """
+    Returns an endless tf.data.Dataset of (X, Y) batches, the same batches
+    get_train_gen yields, which KerasPilot.train accepts in place of the
+    generators.
+
+    Rows are read from all tubs in parallel and interleaved, images are read
+    and decoded with tf.data's thread pool and batches are prefetched.
+
+    Parameters
+    ----------
+    tub : Tub or TubGroup
+    df : DataFrame
+        Subset of tub.get_df() to use, all records if None.
+    cache : str
+        None to decode the images every epoch, '' to keep the decoded
+        records in memory after the first epoch or the path of a file to
+        cache them in.
+    shuffle_buffer : int
+        Records to shuffle across when cache is used. Without a cache every
+        epoch is a full permutation of each tub.
+    """
+    if df is None:
+        df = tub.get_df()
+    parts = split_by_tub(tub, df)
+    if not parts:
+        raise ValueError('Can not make a dataset from an empty set of records')
+
+    rows = pd.concat(parts)
+    counts = np.array([len(p) for p in parts], dtype=np.int64)
+    starts = np.cumsum(counts) - counts
+
+    keys = X_keys + Y_keys
+    image_keys = [k for k in keys if tub.get_input_type(k) == 'image_array']
+    columns = {}
+    plain_files = True
+    for k in keys:
+        if k in image_keys:
+            paths = rows[k].to_numpy().astype(str)
+            plain_files = plain_files and not any(is_blob_ref(p) for p in paths)
+            columns[k] = tf.constant(paths)
+        else:
+            columns[k] = tf.constant(rows[k].to_numpy(dtype=np.float32))
+
+    starts = tf.constant(starts)
+    counts = tf.constant(counts)
+    # a cache replays the first epoch in the same order, so shuffle after it
+    shuffle_rows = shuffle and cache is None
+
+    def tub_rows(i):
+        ds = tf.data.Dataset.range(starts[i], starts[i] + counts[i])
+        if shuffle_rows:
+            ds = ds.shuffle(counts[i], reshuffle_each_iteration=True)
+        return ds
+
+    def load(row):
+        record = {}
+        for k in keys:
+            val = tf.gather(columns[k], row)
+            if k in image_keys:
+                if plain_files:
+                    data = tf.io.read_file(val)
+                else:
+                    data = tf.numpy_function(_read_blob, [val], tf.string, stateful=False)
+                    data.set_shape([])
+                val = tf.io.decode_jpeg(data, channels=3)
+            record[k] = val
+        return record
+
+    def to_xy(batch):
+        X = tuple(tf.cast(batch[k], tf.float32) for k in X_keys)
+        Y = tuple(batch[k] for k in Y_keys)
+        return X, Y
+
+    ds = tf.data.Dataset.range(len(parts))
+    ds = ds.interleave(tub_rows, cycle_length=len(parts), num_parallel_calls=AUTOTUNE,
+                       deterministic=not shuffle)
+    ds = ds.map(load, num_parallel_calls=AUTOTUNE, deterministic=not shuffle)
+    if cache is not None:
+        ds = ds.cache(cache)
+        if shuffle:
+            ds = ds.shuffle(shuffle_buffer, reshuffle_each_iteration=True)
+    ds = ds.repeat()
+    ds = ds.batch(batch_size, drop_remainder=True)
+    ds = ds.map(to_xy, num_parallel_calls=AUTOTUNE)
+    return ds.prefetch(AUTOTUNE)
+
+
+def make_train_val_datasets(tub, X_keys, Y_keys, batch_size=128, train_frac=.8, cache=None):
+    """
+    The tf.data counterpart of Tub.get_train_val_gen, with the same split
+    of the records. With a cache file path, the validation records are
+    cached next to it.
+    """
+    df = tub.get_df()
+    train_df = df.sample(frac=train_frac, random_state=200)
+    val_df = df.drop(train_df.index)
+    val_cache = cache + '.val' if cache else cache
+
+    logger.info('tf.data pipeline over {} train and {} validation records'.format(len(train_df), len(val_df)))
+    train_ds = make_dataset(tub, X_keys, Y_keys, df=train_df, batch_size=batch_size, cache=cache)
+    val_ds = make_dataset(tub, X_keys, Y_keys, df=val_df, batch_size=batch_size, cache=val_cache)
+    return train_ds, val_ds
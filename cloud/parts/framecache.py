@@ -0,0 +1,156 @@
+"""
+framecache.py
+
+Decode the images of a tub once and keep them as a memory-mapped uint8
+array, so training epochs don't decode the same jpegs again.
+
+"""
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+from PIL import Image
+
+from log import get_logger
+from parts.tublog import open_blob
+
+logger = get_logger(__name__)
+
+FRAMES_FILE = 'frames.npy'
+IXS_FILE = 'ixs.npy'
+ENTRY_META_FILE = 'entry.json'
+
+
+class TubFrames(object):
+    """
+    The decoded images of one key of a tub, looked up by record ix.
+    """
+
+    def __init__(self, frames, ixs):
+        self.frames = frames
+        self.ixs = ixs
+
+    def __len__(self):
+        return len(self.ixs)
+
+    @property
+    def shape(self):
+        return self.frames.shape
+
+    def row(self, ix):
+        row = int(np.searchsorted(self.ixs, ix))
+        if row == len(self.ixs) or self.ixs[row] != ix:
+            raise KeyError('record {} is not materialized'.format(ix))
+        return row
+
+    def get(self, ix):
+        """ A view of the frame of record ix, nothing is copied. """
+        return self.frames[self.row(ix)]
+
+
+class FrameCache(object):
+    """
+    A directory of materialized tubs, one entry per tub path and key.
+
+    Entries are checked against the record index of the tub and rebuilt
+    when records were added or removed. Once the entries take more than
+    budget bytes the least recently used ones are evicted, except those
+    loaded through this FrameCache, which are mapped by the current run.
+    """
+
+    def __init__(self, path, budget):
+        self.path = os.path.expanduser(path)
+        self.budget = budget
+        # entry paths loaded by this run
+        self.in_use = set()
+        os.makedirs(self.path, exist_ok=True)
+
+    def entry_path(self, tub_path, key):
+        name = hashlib.sha1('{}\0{}'.format(os.path.abspath(tub_path), key).encode()).hexdigest()[:16]
+        return os.path.join(self.path, name)
+
+    def entries(self):
+        """ (last use, size, path) of every entry, incomplete ones count as never used """
+        entries = []
+        for name in os.listdir(self.path):
+            entry_path = os.path.join(self.path, name)
+            meta_path = os.path.join(entry_path, ENTRY_META_FILE)
+            last_use = os.path.getmtime(meta_path) if os.path.exists(meta_path) else 0
+            size = sum(os.path.getsize(os.path.join(entry_path, f)) for f in os.listdir(entry_path))
+            entries.append((last_use, size, entry_path))
+        return entries
+
+    def evict(self, needed):
+        """ Remove least recently used entries until needed bytes fit in the budget. """
+        entries = sorted(self.entries())
+        used = sum(size for _, size, _ in entries)
+        for _, size, entry_path in entries:
+            if used + needed <= self.budget:
+                break
+            if entry_path in self.in_use:
+                # unlinking a mapped entry frees no disk space and the next run rebuilds it
+                continue
+            logger.info('Evicting {:.1f}MB of frames: {}'.format(size / 2 ** 20, entry_path))
+            shutil.rmtree(entry_path, ignore_errors=True)
+            used -= size
+        return used + needed <= self.budget
+
+    def load(self, entry_path, tub_path, key, index_key):
+        meta_path = os.path.join(entry_path, ENTRY_META_FILE)
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta != {'tub': tub_path, 'key': key, 'index_key': index_key}:
+            return None
+
+        # mark as recently used
+        os.utime(meta_path)
+        frames = np.load(os.path.join(entry_path, FRAMES_FILE), mmap_mode='r')
+        ixs = np.load(os.path.join(entry_path, IXS_FILE))
+        self.in_use.add(entry_path)
+        return TubFrames(frames, ixs)
+
+    def materialize(self, tub_path, key, index_key, ixs, paths):
+        """
+        Returns the TubFrames of the images at paths, one per record ix,
+        decoding them first unless an up to date entry exists. Returns None
+        if the images don't fit into the budget.
+        """
+        tub_path = os.path.abspath(tub_path)
+        index_key = [int(v) for v in index_key]
+        entry_path = self.entry_path(tub_path, key)
+
+        frames = self.load(entry_path, tub_path, key, index_key)
+        if frames is not None:
+            return frames
+        if len(paths) == 0:
+            return None
+
+        first = np.asarray(Image.open(open_blob(paths[0])))
+        shape = (len(paths),) + first.shape
+        needed = int(np.prod(shape)) * first.dtype.itemsize
+        shutil.rmtree(entry_path, ignore_errors=True)
+        if not self.evict(needed):
+            logger.warning('Not materializing {}, {:.1f}MB of frames exceed the cache budget'
+                           .format(tub_path, needed / 2 ** 20))
+            return None
+
+        logger.info('Materializing {} frames of {} into {}'.format(len(paths), tub_path, entry_path))
+        os.makedirs(entry_path)
+        arr = np.lib.format.open_memmap(os.path.join(entry_path, FRAMES_FILE), mode='w+',
+                                        dtype=first.dtype, shape=shape)
+        arr[0] = first
+        for i in range(1, len(paths)):
+            arr[i] = np.asarray(Image.open(open_blob(paths[i])))
+        arr.flush()
+        del arr
+        np.save(os.path.join(entry_path, IXS_FILE), np.asarray(ixs, dtype=np.int64))
+
+        # written last, an entry without it is incomplete
+        with open(os.path.join(entry_path, ENTRY_META_FILE), 'w') as f:
+            json.dump({'tub': tub_path, 'key': key, 'index_key': index_key}, f)
+
+        return self.load(entry_path, tub_path, key, index_key)
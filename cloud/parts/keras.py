@@ -5,7 +5,9 @@ functions to run and train autopilots using keras
 
 """
 from typing import Optional
+import numpy as np
 import pandas as pd
+import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras.layers import Input, Dense
 from tensorflow.keras.layers import Convolution2D
@@ -36,6 +38,7 @@ class KerasPilot:
               min_delta=.0005, patience=5, use_early_stop=True, redis_connect=None, task_id=None):
         """
         train_gen: generator that yields an array of images an array of
+        labels, or a tf.data.Dataset of such batches (see parts/dataset.py)
 
         """
 
@@ -65,17 +68,44 @@ class KerasPilot:
         if use_early_stop:
             callbacks_list.append(early_stop)
 
-        history: keras.callbacks.History = self.model.fit_generator(
+        # fit takes tf.data datasets as well as generators
+        history: keras.callbacks.History = self.model.fit(
             train_gen,
             steps_per_epoch=steps,
             epochs=epochs,
             verbose=1,
             validation_data=val_gen,
             callbacks=callbacks_list,
-            validation_steps=steps * (1.0 - train_split) / train_split)
+            validation_steps=max(1, int(steps * (1.0 - train_split) / train_split)))
         return history
 
 
+TFLITE_FILE = 'model.tflite'
+
+
+def export_tflite(model, tflite_path, calibration_images=None):
+    """
+    Convert a keras model to TensorFlow Lite for the car.
+
+    With calibration_images, an array of camera frames from the tubs, the
+    weights and activations are quantized to int8 (post-training). The
+    model keeps float inputs and outputs either way.
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if calibration_images is not None:
+        def representative_dataset():
+            for img in calibration_images:
+                yield [img[np.newaxis].astype(np.float32)]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    with open(tflite_path, 'wb') as f:
+        f.write(converter.convert())
+    return tflite_path
+
+
 class KerasLinear(KerasPilot):
     def __init__(self):
         super().__init__()
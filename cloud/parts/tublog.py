@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+tublog.py
+
+Segmented append-only storage for tub records.
+
+A tub in the log format keeps its records in a few large segment files
+instead of one json file (plus one jpg per image) per record. A record and
+its image blobs are appended to the current segment in a single write and
+located through a fixed-width index file, so reading a record is one seek.
+"""
+import io
+import json
+import os
+import struct
+
+from log import get_logger
+
+logger = get_logger(__name__)
+
+JSON_FORMAT = 'json'
+LOG_FORMAT = 'log'
+FORMATS = (JSON_FORMAT, LOG_FORMAT)
+
+INDEX_FILE = 'records.idx'
+SEGMENT_PREFIX = 'data_'
+SEGMENT_EXT = '.log'
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+# magic, version, number of entries, number of live records, first ix,
+# last ix, mtime of the tub directory (ns) when the index was written.
+INDEX_HEADER = struct.Struct('<4sHqqqqq')
+INDEX_MAGIC = b'TUBX'
+INDEX_VERSION = 1
+
+# record ix, segment number, offset of the json record, length of the json
+# record. A negative length marks a removed record. Records of json tubs
+# have no segment and use -1.
+INDEX_ENTRY = struct.Struct('<qiqi')
+
+
+def segment_name(num):
+    return SEGMENT_PREFIX + str(num).zfill(5) + SEGMENT_EXT
+
+
+def is_log_file(file_name):
+    return file_name == INDEX_FILE or \
+        (file_name.startswith(SEGMENT_PREFIX) and file_name.endswith(SEGMENT_EXT))
+
+
+def make_blob_ref(segment, offset, length):
+    return '{}#{}+{}'.format(segment, offset, length)
+
+
+def is_blob_ref(val):
+    return isinstance(val, str) and (SEGMENT_EXT + '#') in val
+
+
+def open_blob(val):
+    """
+    accepts: path of an image file or a blob reference into a segment
+    returns: something Image.open accepts
+    """
+    if not is_blob_ref(val):
+        return val
+
+    path, location = val.rsplit('#', 1)
+    offset, length = (int(x) for x in location.split('+'))
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return io.BytesIO(f.read(length))
+
+
+class RecordIndex(object):
+    """
+    Fixed-width on-disk index of the records of a tub.
+
+    The header keeps the record count, the ix range and the tub directory
+    mtime at the time of the last update, so it can be trusted without
+    listing the directory. Entries are appended per record; they are only
+    parsed when a lookup by ix is needed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.length = 0
+        self.count = 0
+        self.first_ix = -1
+        self.last_ix = -1
+        self.dir_mtime = 0
+        self.valid = False
+        self._entries = None
+        self._file = None
+        self.load_header()
+
+    def load_header(self):
+        self.valid = False
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, 'rb') as f:
+            header = f.read(INDEX_HEADER.size)
+            size = os.fstat(f.fileno()).st_size
+        if len(header) < INDEX_HEADER.size:
+            return
+
+        magic, version, self.length, self.count, self.first_ix, self.last_ix, self.dir_mtime = \
+            INDEX_HEADER.unpack(header)
+        num_entries = (size - INDEX_HEADER.size) // INDEX_ENTRY.size
+        # an interrupted append leaves the header behind the entries
+        self.valid = magic == INDEX_MAGIC and version == INDEX_VERSION and num_entries == self.length
+
+    def is_stale(self, dir_mtime=None):
+        if not self.valid:
+            return True
+        return dir_mtime is not None and dir_mtime != self.dir_mtime
+
+    @property
+    def entries(self):
+        """ ix -> (position in index, segment, offset, length) of the live records """
+        if self._entries is None:
+            self._entries = {}
+            if self.length:
+                with open(self.path, 'rb') as f:
+                    f.seek(INDEX_HEADER.size)
+                    data = f.read(self.length * INDEX_ENTRY.size)
+                for pos, (ix, seg, offset, length) in enumerate(INDEX_ENTRY.iter_unpack(data)):
+                    if length >= 0:
+                        self._entries[ix] = (pos, seg, offset, length)
+                    else:
+                        self._entries.pop(ix, None)
+        return self._entries
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, ix):
+        return ix in self.entries
+
+    def get_index(self):
+        return sorted(self.entries)
+
+    def last_entry(self):
+        """ (ix, segment, offset, length) of the last appended record, or None """
+        if not self.length:
+            return None
+        with open(self.path, 'rb') as f:
+            f.seek(INDEX_HEADER.size + (self.length - 1) * INDEX_ENTRY.size)
+            return INDEX_ENTRY.unpack(f.read(INDEX_ENTRY.size))
+
+    def _get_file(self):
+        if self._file is None:
+            self._file = open(self.path, 'r+b')
+        return self._file
+
+    def _write_header(self, f):
+        f.seek(0)
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, self.length, self.count,
+                                  self.first_ix, self.last_ix, self.dir_mtime))
+        f.flush()
+
+    def append(self, ix, seg, offset, length, dir_mtime=0):
+        f = self._get_file()
+        f.seek(INDEX_HEADER.size + self.length * INDEX_ENTRY.size)
+        f.write(INDEX_ENTRY.pack(ix, seg, offset, length))
+
+        if self._entries is not None:
+            self._entries[ix] = (self.length, seg, offset, length)
+        self.length += 1
+        self.count += 1
+        self.first_ix = ix if self.first_ix < 0 else min(self.first_ix, ix)
+        self.last_ix = max(self.last_ix, ix)
+        self.dir_mtime = dir_mtime
+        self._write_header(f)
+
+    def remove(self, ix, dir_mtime=0):
+        """ Mark a record as removed, its entry stays in place. """
+        pos, seg, offset, _ = self.entries.pop(ix)
+        f = self._get_file()
+        f.seek(INDEX_HEADER.size + pos * INDEX_ENTRY.size)
+        f.write(INDEX_ENTRY.pack(ix, seg, offset, -1))
+
+        self.count = len(self._entries)
+        self.first_ix = min(self._entries) if self._entries else -1
+        self.last_ix = max(self._entries) if self._entries else -1
+        self.dir_mtime = dir_mtime
+        self._write_header(f)
+
+    def rebuild(self, records):
+        """
+        Replace the index by the (ix, segment, offset, length) records.
+        """
+        self.close()
+        records = sorted(records)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            ixs = [r[0] for r in records]
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(records), len(records),
+                                      min(ixs, default=-1), max(ixs, default=-1), 0))
+            for record in records:
+                f.write(INDEX_ENTRY.pack(*record))
+        os.replace(tmp_path, self.path)
+        self._entries = None
+        self.load_header()
+
+    def touch(self, dir_mtime):
+        """ Record the tub directory mtime the index is up to date with. """
+        self.dir_mtime = dir_mtime
+        self._write_header(self._get_file())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+
+
+class TubLog(object):
+    """
+    The segment files and the index of a log tub.
+
+    Image blobs are written in front of the json record they belong to and
+    the record refers to them with a '<segment>#<offset>+<length>' string,
+    which Tub.make_record_paths_absolute turns into an absolute reference.
+    """
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+        self.segment = None
+        self._segment_file = None
+        self.index = RecordIndex(os.path.join(path, INDEX_FILE))
+        if self.index.is_stale():
+            self.recover_index()
+
+    def recover_index(self):
+        """
+        The index of a log tub is the only copy of the record locations, so a
+        stale header is recomputed from the entries instead of the directory.
+        """
+        path = self.index.path
+        if not os.path.exists(path):
+            self.index.rebuild([])
+            return
+
+        logger.warning('Recovering record index {}'.format(path))
+        with open(path, 'rb') as f:
+            data = f.read()
+        header = INDEX_HEADER.size if data[:len(INDEX_MAGIC)] == INDEX_MAGIC else 0
+        data = data[header:]
+        data = data[:len(data) - len(data) % INDEX_ENTRY.size]  # torn trailing entry
+
+        entries = {}
+        for ix, seg, offset, length in INDEX_ENTRY.iter_unpack(data):
+            if length >= 0:
+                entries[ix] = (ix, seg, offset, length)
+            else:
+                entries.pop(ix, None)
+        self.index.rebuild(entries.values())
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, ix):
+        return ix in self.index
+
+    def get_index(self):
+        return self.index.get_index()
+
+    def segment_path(self, num):
+        return os.path.join(self.path, segment_name(num))
+
+    def files(self):
+        """ Paths of every file that makes up the log. """
+        segments = {seg for _, seg, _, _ in self.index.entries.values()}
+        return [self.segment_path(seg) for seg in sorted(segments)] + [self.index.path]
+
+    def _get_segment_file(self):
+        f = self._segment_file
+        if f is not None and f.tell() < self.segment_size:
+            return f
+
+        if f is not None:
+            f.close()
+            self.segment += 1
+        elif self.segment is None:
+            last = self.index.last_entry()
+            self.segment = last[1] if last else 0
+        self._segment_file = open(self.segment_path(self.segment), 'ab')
+        return self._segment_file
+
+    def append(self, ix, record, blobs=None):
+        """
+        Append a record and its binary blobs to the current segment.
+        The record values of the blob keys are replaced by blob references.
+        """
+        f = self._get_segment_file()
+        offset = f.tell()
+        name = segment_name(self.segment)
+
+        chunks = []
+        for key, blob in (blobs or {}).items():
+            record[key] = make_blob_ref(name, offset, len(blob))
+            chunks.append(blob)
+            offset += len(blob)
+
+        payload = json.dumps(record).encode()
+        chunks.append(payload)
+        f.write(b''.join(chunks))
+        f.flush()
+
+        self.index.append(ix, self.segment, offset, len(payload))
+
+    def read(self, ix):
+        try:
+            _, seg, offset, length = self.index.entries[ix]
+        except KeyError:
+            raise FileNotFoundError('record {} is not in {}'.format(ix, self.index.path))
+
+        with open(self.segment_path(seg), 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.read(length).decode())
+
+    def remove(self, ix):
+        """
+        Mark a record as removed. Its bytes stay in the segment.
+        """
+        self.index.remove(ix)
+
+    def close(self):
+        if self._segment_file is not None:
+            self._segment_file.close()
+        self._segment_file = None
+        self.index.close()
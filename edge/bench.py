@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Run the vehicle graph of main.py without the car and report how fast it
+drives: loop rate, run times of the parts and the latency from a camera
+frame to the motor command computed from it.
+
+Usage:
+    python bench.py [--tub PATH] [--model PATH] [--loops 400] [--hz 20] [--fps 20]
+                    [--workers 0] [--record] [--async]
+
+The camera replays the frames of a tub, or of a small synthetic tub when
+none is given, and the motor commands go to a fake serial port. Without a
+model a stand-in pilot returns a constant angle and throttle, so the
+pilot's run time is then not that of a real one. The web controller is
+replaced by constant user controls in 'local' mode, so the pilot drives.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from config import load_config
+from parts.camera import ReplayCamera
+from parts.clock import Timestamp
+from parts.datastore import TubHandler, TubWriter
+from parts.transform import Lambda
+from parts.usbserial import CarEngine, FakeSerial
+from profiler import LatencyHistogram
+from vehicle import Vehicle
+
+
+class StandInPilot(object):
+    """ The run(img_arr) contract of the pilots, without a model. """
+
+    def run(self, img_arr):
+        return 0.0, 0.5
+
+    def shutdown(self):
+        pass
+
+
+class TimedCarEngine(CarEngine):
+    """
+    A CarEngine that also takes the time the frame the commands were
+    computed from was published, and records the time to the first motor
+    command sent for each frame.
+    """
+
+    def __init__(self, port):
+        super(TimedCarEngine, self).__init__(port=port)
+        self.latency = LatencyHistogram()
+        self.timed_frame = None
+
+    def run(self, angle, throttle, frame_time=None):
+        writes = self.port.writes
+        super(TimedCarEngine, self).run(angle, throttle)
+        if self.port.writes > writes and frame_time is not None and frame_time != self.timed_frame:
+            self.timed_frame = frame_time
+            self.latency.record(self.port.last_write_time - frame_time)
+
+
+def make_synthetic_tub(path, records, resolution):
+    tub = TubWriter(path, inputs=['cam/image_array', 'user/angle', 'user/throttle', 'user/mode'],
+                    types=['image_array', 'float', 'float', 'str'])
+    rnd = np.random.RandomState(0)
+    for _ in range(records):
+        tub.run(rnd.randint(0, 255, resolution + (3,), dtype=np.uint8), 0.0, 0.0, 'user')
+    return path
+
+
+def load_pilot(args, cfg):
+    if args.model is None:
+        return StandInPilot()
+    if args.pilot == 'tflite':
+        from parts.tflite import TFLitePilot
+        pilot = TFLitePilot(num_threads=cfg.TFLITE_THREADS)
+    else:
+        from parts.keras import KerasLinear
+        pilot = KerasLinear(engine=cfg.PILOT_ENGINE)
+    pilot.load(os.path.expanduser(args.model))
+    return pilot
+
+
+def build_vehicle(args, cfg, tmp_dir):
+    """ The parts of main.drive, with the camera, serial port and web controller replaced. """
+    V = Vehicle(stats_interval=None, workers=args.workers)
+    V.add(Timestamp(), outputs=['timestamp'])
+
+    tub_path = args.tub or make_synthetic_tub(os.path.join(tmp_dir, 'replay'), args.frames,
+                                              tuple(cfg.CAMERA_RESOLUTION))
+    cam = ReplayCamera(tub_path, framerate=args.fps)
+    V.add(cam, outputs=['cam/image_array', 'cam/frame_time'], threaded=True)
+
+    V.add(Lambda(lambda mode: mode != 'user'), inputs=['user/mode'], outputs=['run_pilot'])
+    V.add(load_pilot(args, cfg), inputs=['cam/image_array'],
+          outputs=['pilot/angle', 'pilot/throttle'],
+          run_condition='run_pilot', only_on_change=True)
+
+    # the web controller, with nobody at the wheel
+    V.add(Lambda(lambda: (0.0, 0.0, 'local', args.record)),
+          outputs=['user/angle', 'user/throttle', 'user/mode', 'recording'])
+
+    def drive_mode(mode, user_angle, user_throttle, pilot_angle, pilot_throttle):
+        if mode == 'user':
+            return user_angle, user_throttle
+        else:
+            return pilot_angle, pilot_throttle
+
+    V.add(Lambda(drive_mode), inputs=['user/mode', 'user/angle', 'user/throttle',
+                                      'pilot/angle', 'pilot/throttle'],
+          outputs=['angle', 'throttle'])
+
+    engine = TimedCarEngine(FakeSerial())
+    V.add(engine, inputs=['angle', 'throttle', 'cam/frame_time'])
+
+    if args.record:
+        inputs = ['cam/image_array', 'user/angle', 'user/throttle', 'user/mode']
+        types = ['image_array', 'float', 'float', 'str']
+        th = TubHandler(path=tmp_dir)
+        if cfg.TUB_QUEUE_SIZE > 0:
+            tub = th.new_async_tub_writer(inputs=inputs, types=types, fmt=cfg.TUB_FORMAT,
+                                          queue_size=cfg.TUB_QUEUE_SIZE, backpressure=cfg.TUB_BACKPRESSURE)
+            V.add(tub, inputs=inputs, run_condition='recording', threaded=True)
+        else:
+            tub = th.new_tub_writer(inputs=inputs, types=types, fmt=cfg.TUB_FORMAT)
+            V.add(tub, inputs=inputs, run_condition='recording')
+    return V, cam, engine
+
+
+def main():
+    cfg = load_config()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tub', help='tub to replay the frames of, a synthetic one by default')
+    parser.add_argument('--frames', type=int, default=100, help='frames of the synthetic tub')
+    parser.add_argument('--model', help='model to drive with, a stand-in pilot by default')
+    parser.add_argument('--pilot', choices=['tflite', 'keras'], default=cfg.PILOT_TYPE)
+    parser.add_argument('--loops', type=int, default=400)
+    parser.add_argument('--hz', type=float, default=cfg.DRIVE_LOOP_HZ)
+    parser.add_argument('--fps', type=float, default=cfg.CAMERA_FRAMERATE)
+    parser.add_argument('--workers', type=int, default=cfg.VEHICLE_WORKERS)
+    parser.add_argument('--missed-tick', default=cfg.MISSED_TICK)
+    parser.add_argument('--record', action='store_true', help='write a tub like when recording')
+    parser.add_argument('--async', dest='run_async', action='store_true', help='drive with Vehicle.run_async')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        V, cam, engine = build_vehicle(args, cfg, tmp_dir)
+        run = V.run_async if args.run_async else V.start
+        start = time.perf_counter()
+        run(rate_hz=args.hz, max_loop_count=args.loops, missed_tick=args.missed_tick)
+        # the vehicle waits a second for the parts to warm up
+        elapsed = time.perf_counter() - start - 1
+
+    stats = V.stats()
+    print('{} loops at {}Hz, camera at {}fps, {} workers{}'.format(
+        stats['loops'], args.hz, args.fps, args.workers, ', async' if args.run_async else ''))
+    print('loop: {:.2f}Hz, period p50/p99 {:.1f}/{:.1f}ms, overruns: {}, missed: {}'.format(
+        stats['loops'] / elapsed, stats['period']['p50'], stats['period']['p99'], stats['overruns'],
+        stats['missed']))
+    print('camera: {:.2f}fps'.format(cam.frame_count / (elapsed + 1)))
+
+    print('{:<20} {:>6} {:>8} {:>9} {:>9} {:>9} {:>9}'.format(
+        'part', 'runs', 'skipped', 'mean', 'p50', 'p99', 'max'))
+    for name in (entry['name'] for entry in V.parts):
+        part = stats['parts'].get(name, {'count': 0, 'skipped': 0})
+        if part['count']:
+            print('{:<20} {:>6} {:>8} {:>7.2f}ms {:>7.2f}ms {:>7.2f}ms {:>7.2f}ms'.format(
+                name, part['count'], part['skipped'], part['mean'], part['p50'], part['p99'], part['max']))
+        else:
+            print('{:<20} {:>6} {:>8}'.format(name, 0, part['skipped']))
+
+    latency = engine.latency.summary()
+    if latency['count']:
+        print('frame to actuation: {} frames, mean {:.1f}ms, p50/p90/p99 {:.1f}/{:.1f}/{:.1f}ms, max {:.1f}ms'
+              .format(latency['count'], latency['mean'], latency['p50'], latency['p90'], latency['p99'],
+                      latency['max']))
+    else:
+        print('frame to actuation: no frame reached the motors')
+
+
+if __name__ == '__main__':
+    main()
@@ -22,11 +22,32 @@ MODELS_PATH = "~/mycar/model"
 # VEHICLE
 DRIVE_LOOP_HZ = 20
 MAX_LOOPS = 100000
+VEHICLE_WORKERS = 0  # threads running parts with disjoint channels concurrently, 0 runs parts in order
+MISSED_TICK = 'skip'  # 'skip', 'catch_up' or 'degrade' (only critical parts) when parts overrun a loop
+VEHICLE_STATS_INTERVAL = 60  # seconds between drive loop timing summaries in the log, 0 to disable
+VEHICLE_ASYNC = False  # run the drive loop and the web controller on one asyncio event loop
 
 # CAMERA
 CAMERA_RESOLUTION = (120, 160)  # (height, width)
 CAMERA_FRAMERATE = DRIVE_LOOP_HZ
 
+# VIDEO
+# defaults of the /video stream, a client can ask for others, e.g. /video?scale=0.5&quality=50&fps=10
+VIDEO_SCALE = 1.0  # size of the streamed frames relative to the camera's
+VIDEO_QUALITY = 75  # jpeg quality, 10 - 95
+VIDEO_MAX_FPS = 0  # 0 streams at the camera frame rate
+VIDEO_ADAPTIVE = False  # lower the quality, then the frame rate, while the link can't keep up
+
+# TUB
+TUB_FORMAT = 'log'  # 'json' writes one file per record, 'log' appends records to segment files
+TUB_QUEUE_SIZE = 100  # records buffered by the background tub writer, 0 writes in the drive loop
+TUB_BACKPRESSURE = 'drop_oldest'  # 'block', 'drop_oldest' or 'drop_newest' when the queue is full
+
+# PILOT
+PILOT_TYPE = 'tflite'  # 'tflite' runs model.tflite without tensorflow, 'keras' runs the SavedModel
+TFLITE_THREADS = 2
+PILOT_ENGINE = 'function'  # 'function' runs a traced tf.function, 'direct' calls the model eagerly
+
 # TRAINING
 BATCH_SIZE = 128
 TRAIN_TEST_SPLIT = 0.8
@@ -35,3 +56,7 @@ TRAIN_TEST_SPLIT = 0.8
 CLOUD_IP = "106.12.88.113"
 ACCESS_KEY = "minioadmin"
 SECRET_KEY = "minioadmin"
+CLOUD_TIMEOUT = 30  # seconds until a request to the training service fails
+CLOUD_STATUS_MAX_AGE = 5  # seconds the training status is served from the cache
+TRANSFER_WORKERS = 1  # threads running uploads and downloads
+TRANSFER_MAX_KBPS = 2048  # bandwidth of all transfers together, 0 for no limit
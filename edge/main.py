@@ -5,7 +5,7 @@ from config import load_config
 #from parts.camera import PiCamera
 from parts.clock import Timestamp
 from parts.datastore import TubHandler
-from parts.keras import KerasLinear
+from parts.tflite import TFLitePilot
 from parts.transform import Lambda
 from parts.usbserial import CarEngine
 from vehicle import Vehicle
@@ -13,7 +13,7 @@ from parts.web_controller import LocalWebController
 
 
 def drive(config):
-    V = Vehicle()
+    V = Vehicle(stats_interval=config.VEHICLE_STATS_INTERVAL, workers=config.VEHICLE_WORKERS)
     clock = Timestamp()
     V.add(clock, outputs=['timestamp'])
 
@@ -32,7 +32,12 @@ def drive(config):
     V.add(pilot_condition_part, inputs=['user/mode'], outputs=['run_pilot'])
 
     # Run the pilot if the mode is not user
-    # kl = KerasLinear()
+    # if config.PILOT_TYPE == 'tflite':
+    #     kl = TFLitePilot(num_threads=config.TFLITE_THREADS)
+    # else:
+    #     # imports tensorflow, which takes a while and a lot of memory on the pi
+    #     from parts.keras import KerasLinear
+    #     kl = KerasLinear(engine=config.PILOT_ENGINE)
     # model_path = config.MODELS_PATH
     # model_path = os.path.expanduser(model_path)
     # if os.path.exists(model_path):
@@ -40,9 +45,9 @@ def drive(config):
     #
     # V.add(kl, inputs=['cam/image_array'],
     #       outputs=['pilot/angle', 'pilot/throttle'],
-    #       run_condition='run_pilot')
+    #       run_condition='run_pilot', only_on_change=True)
     kl = None
-    ctr = LocalWebController(kl)
+    ctr = LocalWebController(kl, vehicle=V)
     V.add(ctr,
           inputs=['cam/image_array'],
           outputs=['user/angle', 'user/throttle', 'user/mode', 'recording'],
@@ -77,13 +82,21 @@ def drive(config):
         os.mkdir(tub_path)
 
     # th = TubHandler(path=tub_path)
-    # tub = th.new_tub_writer(inputs=inputs, types=types)
-    #
-    # V.add(tub, inputs=inputs, run_condition='recording')
+    # if config.TUB_QUEUE_SIZE > 0:
+    #     # jpeg encoding and disk writes happen on the writer's own thread
+    #     tub = th.new_async_tub_writer(inputs=inputs, types=types, fmt=config.TUB_FORMAT,
+    #                                   queue_size=config.TUB_QUEUE_SIZE,
+    #                                   backpressure=config.TUB_BACKPRESSURE)
+    #     V.add(tub, inputs=inputs, run_condition='recording', threaded=True)
+    # else:
+    #     tub = th.new_tub_writer(inputs=inputs, types=types, fmt=config.TUB_FORMAT)
+    #     V.add(tub, inputs=inputs, run_condition='recording')
 
     # run the vehicle
-    V.start(rate_hz=config.DRIVE_LOOP_HZ,
-            max_loop_count=config.MAX_LOOPS)
+    run = V.run_async if config.VEHICLE_ASYNC else V.start
+    run(rate_hz=config.DRIVE_LOOP_HZ,
+        max_loop_count=config.MAX_LOOPS,
+        missed_tick=config.MISSED_TICK)
 
 
 if __name__ == '__main__':
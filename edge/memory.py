@@ -5,14 +5,193 @@ Created on Sun Jun 25 11:07:48 2017
 
 @author: wroscoe
 """
+import functools
+import operator
+
+import numpy as np
+
+# an input named '<channel>@<k>' reads the last k values of a channel history
+HISTORY_SEP = '@'
+
+
+def split_history_key(key):
+    """ (channel, k) of a history input, (key, None) for a plain channel """
+    channel, sep, k = key.rpartition(HISTORY_SEP)
+    if sep and k.isdigit():
+        return channel, int(k)
+    return key, None
+
+
+class ChannelHistory:
+    """
+    The last `length` values of a channel in a preallocated numpy array.
+
+    Every value is written twice, `length` rows apart, so the last k values
+    are always one contiguous slice and last(k) can return a view instead
+    of copying. The array is allocated with the shape and dtype of the
+    first value.
+    """
+    def __init__(self, length):
+        self.length = length
+        self.buffer = None
+        self.count = 0
+
+    def append(self, value):
+        value = np.asarray(value)
+        if self.buffer is None:
+            self.buffer = np.zeros((2 * self.length,) + value.shape, dtype=value.dtype)
+        pos = self.count % self.length
+        self.buffer[pos] = value
+        self.buffer[pos + self.length] = value
+        self.count += 1
+
+    def last(self, k):
+        """
+        A read-only view of the last k values, oldest first, fewer while less
+        than k values were written. It stays valid for length - k further
+        values of the channel.
+        """
+        if k > self.length:
+            raise ValueError('history of {} values has no last {}'.format(self.length, k))
+        if self.buffer is None:
+            return None
+        k = min(k, self.count)
+        end = self.count % self.length + self.length
+        view = self.buffer[end - k:end]
+        view.flags.writeable = False
+        return view
 
 
 class Memory:
     """
     A convenience class to save key/value pairs.
+
+    Every channel name gets an integer slot in a list of values the first
+    time it is used. The vehicle resolves the channels of a part to slots
+    once, with getter and setter, so the drive loop reads and writes values
+    by index instead of looking names up. A channel a getter or setter was
+    made for exists from then on, with the value None until it is written.
+
+    Each channel has a version, counting the writes of a value that is not
+    the object the channel already holds. Parts returning their latest
+    value every loop, like threaded parts, don't change the version until
+    they have a new value. Channels declared with declare_history also
+    keep their last values, see ChannelHistory.
     """
     def __init__(self, *args, **kw):
-        self.d = {}
+        self.slots = {}
+        # only ever appended to, the getters and setters hold on to it
+        self.store = []
+        self.versions = []
+        self.histories = {}
+        self.setters = set()
+
+    def declare_history(self, key, length):
+        """
+        Keep the last length values of channel key. Parts read them with the
+        input '<key>@<k>'. Has to be declared before a part writing the
+        channel is added to the vehicle.
+        """
+        if key in self.setters:
+            raise ValueError('Declare the history of {} before adding parts writing it'.format(key))
+        history = self.histories.get(key)
+        if history is None or history.length < length:
+            history = self.histories[key] = ChannelHistory(length)
+        return history
+
+    def history(self, key):
+        return self.histories[key]
+
+    def slot(self, key):
+        """ The index of the value of channel key, added if it is new. """
+        ix = self.slots.get(key)
+        if ix is None:
+            ix = self.slots[key] = len(self.store)
+            self.store.append(None)
+            self.versions.append(0)
+        return ix
+
+    def reader(self, key):
+        """ A function returning the value of the channel key, or the view of its history. """
+        channel, k = split_history_key(key)
+        if k is not None:
+            if channel not in self.histories:
+                raise KeyError('{} reads the history of {}, which has none declared'.format(key, channel))
+            return functools.partial(self.histories[channel].last, k)
+        return functools.partial(operator.getitem, self.store, self.slot(key))
+
+    def getter(self, keys):
+        """ A function returning the values of the channels keys, as a sequence. """
+        store = self.store
+        if any(split_history_key(k)[1] is not None for k in keys):
+            readers = [self.reader(k) for k in keys]
+            return lambda: [read() for read in readers]
+
+        slots = [self.slot(k) for k in keys]
+        if not slots:
+            return lambda: ()
+        if len(slots) == 1:
+            ix = slots[0]
+            return lambda: (store[ix],)
+        get = operator.itemgetter(*slots)
+        return lambda: get(store)
+
+    def setter(self, keys):
+        """
+        A function saving the outputs of a part to the channels keys, like put:
+        a part with one channel returns the value itself.
+        """
+        store = self.store
+        versions = self.versions
+        slots = [self.slot(k) for k in keys]
+        self.setters.update(keys)
+        histories = {ix: self.histories[k] for k, ix in zip(keys, slots) if k in self.histories}
+        if not slots:
+            def put(outputs):
+                raise IndexError('outputs {!r} but no keys to save them to'.format(outputs))
+        elif len(slots) == 1:
+            ix = slots[0]
+            history = histories.get(ix)
+
+            def put(outputs):
+                if store[ix] is not outputs:
+                    store[ix] = outputs
+                    versions[ix] += 1
+                    if history is not None and outputs is not None:
+                        history.append(outputs)
+        else:
+            def put(outputs):
+                if len(outputs) < len(slots):
+                    raise IndexError('{} outputs for keys: {}'.format(len(outputs), keys))
+                for ix, value in zip(slots, outputs):
+                    if store[ix] is not value:
+                        store[ix] = value
+                        versions[ix] += 1
+                        if ix in histories and value is not None:
+                            histories[ix].append(value)
+        return put
+
+    def version(self, key):
+        """ How often a new value was written to channel key, 0 if never. """
+        ix = self.slots.get(key)
+        return self.versions[ix] if ix is not None else 0
+
+    def version_getter(self, keys):
+        """ A function returning the versions of the channels keys, histories count as their channel. """
+        versions = self.versions
+        slots = [self.slot(split_history_key(k)[0]) for k in keys]
+        if not slots:
+            return lambda: ()
+        get = operator.itemgetter(*slots)
+        if len(slots) == 1:
+            return lambda: (get(versions),)
+        return lambda: get(versions)
+
+    @property
+    def d(self):
+        """ A copy of the channels as a dict. """
+        store = self.store
+        return {k: store[ix] for k, ix in self.slots.items()}
 
     def __setitem__(self, key, value):
         if type(key) is not tuple:
@@ -20,37 +199,39 @@ class Memory:
             value=(value,)
 
         for i, k in enumerate(key):
-            self.d[k] = value[i]
+            ix = self.slot(k)
+            if self.store[ix] is not value[i]:
+                self.store[ix] = value[i]
+                self.versions[ix] += 1
+                if k in self.histories and value[i] is not None:
+                    self.histories[k].append(value[i])
 
     def __getitem__(self, key):
         if type(key) is tuple:
-            return [self.d[k] for k in key]
+            return [self.store[self.slots[k]] for k in key]
         else:
-            return self.d[key]
+            return self.store[self.slots[key]]
+
+    def __contains__(self, key):
+        return key in self.slots
 
     def update(self, new_d):
-        self.d.update(new_d)
+        for k, v in new_d.items():
+            self[k] = v
 
     def put(self, keys, inputs):
-        if len(keys) > 1:
-            for i, key in enumerate(keys):
-                try:
-                    self.d[key] = inputs[i]
-                except IndexError as e:
-                    error = str(e) + ' issue with keys: ' + str(key)
-                    raise IndexError(error)
-        else:
-            self.d[keys[0]] = inputs
+        self.setter(keys)(inputs)
 
     def get(self, keys):
-        result = [self.d.get(k) for k in keys]
+        store = self.store
+        result = [store[self.slots[k]] if k in self.slots else None for k in keys]
         return result
 
     def keys(self):
-        return self.d.keys()
+        return self.slots.keys()
 
     def values(self):
         return self.d.values()
 
     def items(self):
-        return self.d.items()
\ No newline at end of file
+        return self.d.items()
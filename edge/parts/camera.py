@@ -53,3 +53,61 @@ class PiCamera(BaseCamera):
         self.stream.close()
         self.rawCapture.close()
         self.camera.close()
+
+
+class ReplayCamera(BaseCamera):
+    """
+    Streams the frames of a recorded tub at the camera's frame rate, for
+    running the vehicle without a camera. Add it threaded with the outputs
+    ['cam/image_array', 'cam/frame_time']: the frame time is the
+    time.perf_counter() when the frame was published, to time how long
+    frames take to reach the actuators.
+
+    The frames are decoded when the camera is created, at most max_frames
+    of them, so the replay costs no more CPU than a real camera would.
+    """
+
+    def __init__(self, tub_path, framerate=20, key='cam/image_array', max_frames=500, loop=True):
+        from parts.datastore import Tub
+        tub = Tub(tub_path)
+        self.frames = [tub.get_record(ix)[key] for ix in tub.get_index(shuffled=False)[:max_frames]]
+        if not self.frames:
+            raise ValueError('No frames to replay in {}'.format(tub_path))
+        self.framerate = framerate
+        self.loop = loop
+        self.frame = None
+        self.frame_time = None
+        self.frame_count = 0
+        self.on = True
+        print('ReplayCamera loaded {} frames from {}'.format(len(self.frames), tub_path))
+
+    def run(self):
+        self.publish()
+        return self.frame, self.frame_time
+
+    def publish(self):
+        if self.frame_count >= len(self.frames) and not self.loop:
+            self.on = False
+            return
+        self.frame = self.frames[self.frame_count % len(self.frames)]
+        self.frame_time = time.perf_counter()
+        self.frame_count += 1
+
+    def update(self):
+        # publish on a fixed schedule, like a camera delivering frames
+        period = 1.0 / self.framerate
+        deadline = time.perf_counter()
+        while self.on:
+            self.publish()
+            deadline += period
+            delay = deadline - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                deadline = time.perf_counter()
+
+    def run_threaded(self):
+        return self.frame, self.frame_time
+
+    def shutdown(self):
+        self.on = False
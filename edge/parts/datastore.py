@@ -5,10 +5,13 @@ Created on Tue Jul  4 12:32:53 2017
 
 @author: wroscoe
 """
+import io
 import os
 import sys
 import time
 import json
+import queue
+import threading
 import datetime
 import random
 import tarfile
@@ -20,9 +23,41 @@ from PIL import Image
 from minio import Minio
 
 from log import get_logger
+from parts.tublog import TubLog, RecordIndex, open_blob, is_log_file, INDEX_FILE, JSON_FORMAT, LOG_FORMAT, FORMATS
 
 logger = get_logger(__name__)
 
+# scalar channels of all records, cached next to meta.json for get_df
+DF_CACHE_FILE = 'records_df.npz'
+
+
+def batch_index_gen(num_records, batch_size, shuffle=True):
+    """
+    Yields arrays of batch_size row positions. Each epoch is a permutation of
+    all rows, and a batch that crosses the end of an epoch is completed from
+    the next one, so every row is used once per epoch and batches stay full.
+    """
+    if num_records == 0:
+        raise ValueError('Can not generate batches from an empty set of records')
+
+    def new_epoch():
+        return np.random.permutation(num_records) if shuffle else np.arange(num_records)
+
+    order = new_epoch()
+    pos = 0
+    while True:
+        parts = []
+        missing = batch_size
+        while missing:
+            if pos == num_records:
+                order = new_epoch()
+                pos = 0
+            part = order[pos:pos + missing]
+            parts.append(part)
+            pos += len(part)
+            missing -= len(part)
+        yield parts[0] if len(parts) == 1 else np.concatenate(parts)
+
 
 class Tub(object):
     """
@@ -38,14 +73,23 @@ class Tub(object):
     >>> types = ['float', 'image']
     >>> t=Tub(path=path, inputs=inputs, types=types)
 
+    New tubs are written as one json file per record unless fmt='log' is
+    passed, which stores the records in an append-only log (see tublog.py).
+    The format is kept in meta.json so both layouts can be read. Either way
+    the records are listed in records.idx, which is kept up to date by
+    put_record and remove_record and rebuilt when it goes stale.
+
     """
 
-    def __init__(self, path, inputs=None, types=None):
+    def __init__(self, path, inputs=None, types=None, fmt=JSON_FORMAT):
 
         self.path = os.path.expanduser(path)
         logger.info('path_in_tub: {}'.format(self.path))
         self.meta_path = os.path.join(self.path, 'meta.json')
         self.df = None
+        self.log = None
+        self.index = None
+        self.frames = {}
 
         exists = os.path.exists(self.path)
         if exists:
@@ -53,15 +97,19 @@ class Tub(object):
             logger.info('Tub exists: {}'.format(self.path))
             with open(self.meta_path, 'r') as f:
                 self.meta = json.load(f)
+            self.open_index()
             self.current_ix = self.get_last_ix() + 1
 
         elif not exists and inputs:
+            if fmt not in FORMATS:
+                raise ValueError('Unknown tub format {}, expected one of {}'.format(fmt, FORMATS))
             logger.info('Tub does NOT exist. Creating new tub...')
             # create log and save meta
             os.makedirs(self.path)
-            self.meta = {'inputs': inputs, 'types': types}
+            self.meta = {'inputs': inputs, 'types': types, 'format': fmt}
             with open(self.meta_path, 'w') as f:
                 json.dump(self.meta, f)
+            self.open_index()
             self.current_ix = 0
             logger.info('New tub created at: {}'.format(self.path))
         else:
@@ -72,34 +120,113 @@ class Tub(object):
 
         self.start_time = time.time()
 
-    def get_last_ix(self):
-        index = self.get_index()
-        if len(index) >= 1:
-            return max(index)
-        return -1
-
-    def update_df(self):
-        df = pd.DataFrame([self.get_json_record(i) for i in self.get_index(shuffled=False)])
-        self.df = df
+    def open_index(self):
+        if self.format == LOG_FORMAT:
+            self.log = TubLog(self.path)
+            self.index = self.log.index
+            return
 
-    def get_df(self):
-        if self.df is None:
-            self.update_df()
-        return self.df
+        self.index = RecordIndex(os.path.join(self.path, INDEX_FILE))
+        if self.index.is_stale(self.dir_mtime()):
+            self.rebuild_index()
 
-    def get_index(self, shuffled=True):
+    def rebuild_index(self):
+        """
+        List the record files of a json tub and write them to the index.
+        """
+        logger.info('Rebuilding record index of tub: {}'.format(self.path))
         files = next(os.walk(self.path))[2]
-        record_files = [f for f in files if f[:6] == 'record']
+        record_files = [f for f in files if f.startswith('record_') and f.endswith('.json')]
 
         def get_file_ix(file_name):
             try:
                 name = file_name.split('.')[0]
-                num = int(name.split('-')[1])
+                num = int(name.split('_')[1])
             except:
                 num = 0
             return num
 
-        nums = [get_file_ix(f) for f in record_files]
+        self.index.rebuild([(get_file_ix(f), -1, 0, 0) for f in record_files])
+        self.index.touch(self.dir_mtime())
+
+    def dir_mtime(self):
+        return os.stat(self.path).st_mtime_ns
+
+    def get_last_ix(self):
+        return self.index.last_ix
+
+    def update_df(self):
+        df = self.load_df_cache()
+        if df is None:
+            df = pd.DataFrame([self.read_json_record(i) for i in self.get_index(shuffled=False)])
+            self.save_df_cache(df)
+        self.df = self.make_df_paths_absolute(df)
+
+    def index_key(self):
+        """ Identifies the set of records, for caches derived from them. """
+        # every put_record and remove_record changes at least one of these
+        index = self.index
+        return np.array([index.length, index.count, index.first_ix, index.last_ix], dtype=np.int64)
+
+    def load_df_cache(self):
+        """
+        Returns the DataFrame of the raw records saved by save_df_cache, or
+        None if there is no cache or records were added or removed since.
+        """
+        path = os.path.join(self.path, DF_CACHE_FILE)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if not np.array_equal(data['__key__'], self.index_key()):
+                    logger.info('Record cache is out of date: {}'.format(path))
+                    return None
+                columns = [str(c) for c in data['__columns__']]
+                return pd.DataFrame({c: data['col_{}'.format(i)] for i, c in enumerate(columns)},
+                                    columns=columns)
+        except Exception as e:
+            logger.warning('Ignoring unreadable record cache {}: {}'.format(path, e))
+            return None
+
+    def save_df_cache(self, df):
+        """
+        Save every column of the raw records DataFrame as a numpy array so
+        the next get_df doesn't have to parse each record again.
+        """
+        arrays = {'__key__': self.index_key(),
+                  '__columns__': np.array(df.columns, dtype=str)}
+        for i, c in enumerate(df.columns):
+            arr = df[c].to_numpy()
+            if arr.dtype == object:
+                if not all(type(v) == str for v in arr):
+                    logger.info('Not caching records of {}, column {} has mixed types'.format(self.path, c))
+                    return
+                arr = arr.astype(str)
+            arrays['col_{}'.format(i)] = arr
+
+        dir_mtime = self.dir_mtime()
+        path = os.path.join(self.path, DF_CACHE_FILE)
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning('Could not save record cache {}: {}'.format(path, e))
+            return
+
+        # creating the cache file is not a change of the records
+        if self.log is None and not self.index.is_stale(dir_mtime):
+            self.index.touch(self.dir_mtime())
+
+    def get_df(self):
+        if self.df is None:
+            self.update_df()
+        return self.df
+
+    def get_index(self, shuffled=True):
+        nums = self.index.get_index()
 
         if shuffled:
             random.shuffle(nums)
@@ -108,6 +235,10 @@ class Tub(object):
 
         return nums
 
+    @property
+    def format(self):
+        return self.meta.get('format', JSON_FORMAT)
+
     @property
     def inputs(self):
         return list(self.meta['inputs'])
@@ -120,11 +251,15 @@ class Tub(object):
         input_types = dict(zip(self.inputs, self.types))
         return input_types.get(key)
 
-    def write_json_record(self, json_data):
-        path = self.get_json_record_path(self.current_ix)
+    def write_json_record(self, json_data, blobs=None):
         try:
-            with open(path, 'w') as fp:
-                json.dump(json_data, fp)
+            if self.log is not None:
+                self.log.append(self.current_ix, json_data, blobs)
+            else:
+                path = self.get_json_record_path(self.current_ix)
+                with open(path, 'w') as fp:
+                    json.dump(json_data, fp)
+                self.index.append(self.current_ix, -1, 0, 0, dir_mtime=self.dir_mtime())
         except TypeError:
             logger.warn('troubles with record: {}'.format(json_data))
         except FileNotFoundError:
@@ -134,9 +269,7 @@ class Tub(object):
             raise
 
     def get_num_records(self):
-        import glob
-        files = glob.glob(os.path.join(self.path, 'record_*.json'))
-        return len(files)
+        return len(self.index)
 
     def make_record_paths_absolute(self, record_dict):
         d = {}
@@ -148,6 +281,25 @@ class Tub(object):
 
         return d
 
+    def make_df_paths_absolute(self, df):
+        """
+        make_record_paths_absolute for all the records of a DataFrame.
+        """
+        prefix = os.path.join(self.path, '')
+        for c in df.columns:
+            col = df[c]
+            if pd.api.types.is_numeric_dtype(col) or pd.api.types.is_bool_dtype(col):
+                continue
+            if pd.api.types.infer_dtype(col, skipna=False) == 'string':
+                is_file = col.str.contains('.', regex=False)
+                if is_file.all():
+                    df[c] = prefix + col
+                elif is_file.any():
+                    df.loc[is_file, c] = prefix + col[is_file]
+            else:
+                df[c] = [os.path.join(self.path, v) if type(v) == str and '.' in v else v for v in col]
+        return df
+
     def check(self, fix=False):
         """
         Iterate over all records and make sure we can load them.
@@ -173,8 +325,12 @@ class Tub(object):
         """
         remove data associate with a record
         """
+        if self.log is not None:
+            self.log.remove(ix)
+            return
         record = self.get_json_record_path(ix)
         os.unlink(record)
+        self.index.remove(ix, dir_mtime=self.dir_mtime())
 
     def put_record(self, data):
         """
@@ -183,6 +339,7 @@ class Tub(object):
         be saved in a csv.
         """
         json_data = {}
+        blobs = {}
         self.current_ix += 1
 
         for key, val in data.items():
@@ -191,23 +348,23 @@ class Tub(object):
             if typ in ['str', 'float', 'int', 'boolean']:
                 json_data[key] = val
 
-            elif typ is 'image':
-                name = self.make_file_name(key, ext='.jpg')
-                val.save(os.path.join(self.path, name))
-                json_data[key] = name
-
-            elif typ == 'image_array':
-                img = Image.fromarray(np.uint8(val))
-                name = self.make_file_name(key, ext='.jpg')
-                img.save(os.path.join(self.path, name))
-                json_data[key] = name
-
+            elif typ in ['image', 'image_array']:
+                img = val if typ == 'image' else Image.fromarray(np.uint8(val))
+                if self.log is not None:
+                    # stored next to the record in the log
+                    buf = io.BytesIO()
+                    img.save(buf, format='jpeg')
+                    blobs[key] = buf.getvalue()
+                else:
+                    name = self.make_file_name(key, ext='.jpg')
+                    img.save(os.path.join(self.path, name))
+                    json_data[key] = name
 
             else:
                 msg = 'Tub does not know what to do with this type {}'.format(typ)
                 raise TypeError(msg)
 
-        self.write_json_record(json_data)
+        self.write_json_record(json_data, blobs)
         return self.current_ix
 
     def get_json_record_path(self, ix):
@@ -215,13 +372,21 @@ class Tub(object):
         # return os.path.join(self.path, 'record_'+str(ix).zfill(6)+'.json')
         # don't fill zeros
         return os.path.join(self.path, 'record_' + str(ix) + '.json')
-        return os.path.join(self.path, 'record_' + str(ix) + '.json')
 
     def get_json_record(self, ix):
-        path = self.get_json_record_path(ix)
+        json_data = self.read_json_record(ix)
+        record_dict = self.make_record_paths_absolute(json_data)
+        return record_dict
+
+    def read_json_record(self, ix):
+        """ The record as it was saved, with paths relative to the tub. """
         try:
-            with open(path, 'r') as fp:
-                json_data = json.load(fp)
+            if self.log is not None:
+                json_data = self.log.read(ix)
+            else:
+                path = self.get_json_record_path(ix)
+                with open(path, 'r') as fp:
+                    json_data = json.load(fp)
         except UnicodeDecodeError:
             raise Exception('bad record: %d. You may want to run `python manage.py check --fix`' % ix)
         except FileNotFoundError:
@@ -230,11 +395,13 @@ class Tub(object):
             logger.error('Unexpected error: {}'.format(sys.exc_info()[0]))
             raise
 
-        record_dict = self.make_record_paths_absolute(json_data)
-        return record_dict
+        return json_data
 
     def get_record(self, ix):
         json_data = self.get_json_record(ix)
+        for key, frames in self.frames.items():
+            if key in json_data:
+                json_data[key] = frames.get(ix)
         data = self.read_record(json_data)
         return data
 
@@ -244,8 +411,8 @@ class Tub(object):
             typ = self.get_input_type(key)
 
             # load objects that were saved as separate files
-            if typ == 'image_array':
-                img = Image.open((val))
+            if typ == 'image_array' and not isinstance(val, np.ndarray):
+                img = Image.open(open_blob(val))
                 val = np.array(img)
 
             data[key] = val
@@ -264,7 +431,10 @@ class Tub(object):
 
     def shutdown(self):
         """ Required by the Part interface """
-        pass
+        if self.log is not None:
+            self.log.close()
+        elif self.index is not None:
+            self.index.close()
 
     def get_record_gen(self, record_transform=None, shuffle=True, df=None):
         """
@@ -291,19 +461,16 @@ class Tub(object):
         if df is None:
             df = self.get_df()
 
-        while True:
-            for row in self.df.iterrows():
-                if shuffle:
-                    record_dict = df.sample(n=1).to_dict(orient='record')[0]
-                else:
-                    record_dict = row[1].to_dict()
+        records = df.to_dict(orient='records')
+        for ixs in batch_index_gen(len(records), batch_size=1, shuffle=shuffle):
+            record_dict = dict(records[ixs[0]])
 
-                if record_transform:
-                    record_dict = record_transform(record_dict)
+            if record_transform:
+                record_dict = record_transform(record_dict)
 
-                record_dict = self.read_record(record_dict)
+            record_dict = self.read_record(record_dict)
 
-                yield record_dict
+            yield record_dict
 
     def get_batch_gen(self, keys=None, batch_size=128, record_transform=None, shuffle=True, df=None):
         """
@@ -322,24 +489,97 @@ class Tub(object):
         -------
         A dict with keys mapping to the specified keys, and values lists of size batch_size.
 
+        Without a record_transform the batches are sliced out of the DataFrame
+        columns with one index array per batch and images are decoded straight
+        into a preallocated batch array. Every record is used once per epoch.
+
         See Also
         --------
         get_record_gen
         """
         if df is None:
             df = self.get_df()
-        record_gen = self.get_record_gen(record_transform=record_transform, shuffle=shuffle, df=df)
 
         if keys is None:
-            keys = list(self.df.columns)
-        while True:
-            record_list = [next(record_gen) for _ in range(batch_size)]
+            keys = list(df.columns)
+
+        if record_transform:
+            # transforms work on single record dicts
+            record_gen = self.get_record_gen(record_transform=record_transform, shuffle=shuffle, df=df)
+            while True:
+                record_list = [next(record_gen) for _ in range(batch_size)]
+                batch_arrays = {}
+                for i, k in enumerate(keys):
+                    arr = np.array([r[k] for r in record_list])
+                    batch_arrays[k] = arr
+                yield batch_arrays
+
+        columns = {k: df[k].to_numpy() for k in keys}
+        image_keys = [k for k in keys if self.get_input_type(k) == 'image_array']
+
+        # materialized images are read by the DataFrame row label instead of decoded
+        segments = {k: self.frame_segments(k) for k in image_keys}
+        segments = {k: v for k, v in segments.items() if v is not None}
+        if segments:
+            labels = df.index.to_numpy()
+            image_keys = [k for k in image_keys if k not in segments]
+            for k in segments:
+                columns[k] = labels
+
+        for ixs in batch_index_gen(len(df), batch_size, shuffle=shuffle):
             batch_arrays = {}
-            for i, k in enumerate(keys):
-                arr = np.array([r[k] for r in record_list])
-                batch_arrays[k] = arr
+            for k in keys:
+                values = columns[k][ixs]
+                if k in segments:
+                    values = self.read_frames(segments[k], values)
+                elif k in image_keys:
+                    values = self.read_images(values)
+                batch_arrays[k] = values
             yield batch_arrays
 
+    def read_images(self, paths):
+        """
+        Decode the images into one new (len(paths), height, width, channels) array.
+        """
+        first = np.asarray(Image.open(open_blob(paths[0])))
+        arr = np.empty((len(paths),) + first.shape, dtype=first.dtype)
+        arr[0] = first
+        for i in range(1, len(paths)):
+            arr[i] = np.asarray(Image.open(open_blob(paths[i])))
+        return arr
+
+    def materialize(self, frame_cache, key='cam/image_array'):
+        """
+        Decode the images of key once into a FrameCache. get_batch_gen and
+        get_record then read them from the memory map instead of decoding.
+        """
+        df = self.get_df()
+        ixs = self.get_index(shuffled=False)
+        frames = frame_cache.materialize(self.path, key, self.index_key(), ixs, df[key].to_numpy())
+        if frames is not None:
+            self.frames[key] = frames
+        return frames
+
+    def frame_segments(self, key):
+        """
+        [(first DataFrame row label, frames)] covering all rows of get_df(),
+        or None if the images of key are not materialized.
+        """
+        frames = self.frames.get(key)
+        if frames is None:
+            # nothing to materialize in an empty tub
+            return [] if self.df is not None and len(self.df) == 0 else None
+        return [(0, frames.frames)]
+
+    def read_frames(self, segments, labels):
+        first = segments[0][1]
+        arr = np.empty((len(labels),) + first.shape[1:], dtype=first.dtype)
+        for start, frames in segments:
+            rows = labels - start
+            in_segment = (rows >= 0) & (rows < len(frames))
+            arr[in_segment] = frames[rows[in_segment]]
+        return arr
+
     def tar_records(self, file_path, start_ix=None, end_ix=None):
         """
         Create a tarfile of the records and metadata from a tub.
@@ -366,9 +606,14 @@ class Tub(object):
             end_ix = self.get_last_ix() + 1
 
         with tarfile.open(name=file_path, mode='w:gz') as f:
-            for ix in range(start_ix, end_ix):
-                record_path = self.get_json_record_path(ix)
-                f.add(record_path)
+            if self.log is not None:
+                # records of a log tub can't be split out of their segments
+                for path in self.log.files():
+                    f.add(path)
+            else:
+                for ix in range(start_ix, end_ix):
+                    record_path = self.get_json_record_path(ix)
+                    f.add(record_path)
             f.add(self.meta_path)
 
         return file_path
@@ -385,8 +630,9 @@ class Tub(object):
             yield X, Y
 
     def get_train_val_gen(self, X_keys, Y_keys, batch_size=128, record_transform=None, train_frac=.8):
-        train_df = train = self.df.sample(frac=train_frac, random_state=200)
-        val_df = self.df.drop(train_df.index)
+        df = self.get_df()
+        train_df = df.sample(frac=train_frac, random_state=200)
+        val_df = df.drop(train_df.index)
 
         train_gen = self.get_train_gen(X_keys=X_keys, Y_keys=Y_keys, batch_size=batch_size,
                                        record_transform=record_transform, df=train_df)
@@ -411,6 +657,116 @@ class TubWriter(Tub):
         self.put_record(record)
 
 
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+BACKPRESSURE_POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+
+class AsyncTubWriter(TubWriter):
+    """
+    A TubWriter that encodes and writes records on a background thread.
+
+    Add it to the vehicle with threaded=True. run_threaded only copies the
+    values into a bounded queue and returns; update drains the queue. When
+    the queue is full the backpressure policy decides whether the drive
+    loop waits (block) or a record is dropped (drop_oldest, drop_newest).
+    """
+
+    def __init__(self, *args, queue_size=100, backpressure=DROP_OLDEST, report_interval=10, **kwargs):
+        if backpressure not in BACKPRESSURE_POLICIES:
+            raise ValueError('Unknown backpressure policy {}, expected one of {}'
+                             .format(backpressure, BACKPRESSURE_POLICIES))
+        super(AsyncTubWriter, self).__init__(*args, **kwargs)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.backpressure = backpressure
+        self.report_interval = report_interval
+        self.dropped = 0
+        self.written = 0
+        self.errors = 0
+        self.on = True
+        self.running = False
+        self.stopped = threading.Event()
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def stats(self):
+        return {'queue_depth': self.queue_depth,
+                'queue_size': self.queue.maxsize,
+                'dropped': self.dropped,
+                'written': self.written,
+                'errors': self.errors}
+
+    def run_threaded(self, *args):
+        assert len(self.inputs) == len(args)
+        # the producer may reuse its buffers, so keep a private copy
+        values = [np.copy(val) if isinstance(val, np.ndarray) else val for val in args]
+        record = dict(zip(self.inputs, values))
+
+        if self.backpressure == BLOCK:
+            self.queue.put(record)
+            return
+
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                self.dropped += 1
+                if self.backpressure == DROP_NEWEST:
+                    return
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+            except queue.Empty:
+                pass
+
+    def write_next(self, timeout=None):
+        try:
+            record = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return False
+
+        try:
+            self.put_record(record)
+            self.written += 1
+        except Exception as e:
+            self.errors += 1
+            logger.error('Failed to write record to {}: {}'.format(self.path, e))
+        finally:
+            self.queue.task_done()
+        return True
+
+    def update(self):
+        self.running = True
+        last_report = time.time()
+        last_dropped = 0
+        while self.on or not self.queue.empty():
+            self.write_next(timeout=0.1)
+
+            if time.time() - last_report > self.report_interval:
+                if self.dropped > last_dropped:
+                    logger.warning('Tub writer dropped {} records in {}s, stats: {}'
+                                   .format(self.dropped - last_dropped, self.report_interval, self.stats()))
+                last_report = time.time()
+                last_dropped = self.dropped
+        self.stopped.set()
+
+    def shutdown(self, timeout=10):
+        self.on = False
+        if self.running:
+            if not self.stopped.wait(timeout):
+                logger.warning('Tub writer did not drain its queue in {}s, stats: {}'
+                               .format(timeout, self.stats()))
+        else:
+            while self.write_next(timeout=0):
+                pass
+        logger.info('Tub writer stopped: {}'.format(self.stats()))
+        super(AsyncTubWriter, self).shutdown()
+
+
 class TubReader(Tub):
     def __init__(self, path, *args, **kwargs):
         super(TubReader, self).__init__(*args, **kwargs)
@@ -456,9 +812,16 @@ class TubHandler():
         tub_path = os.path.join(self.path, name)
         return tub_path
 
-    def new_tub_writer(self, inputs, types):
+    def new_tub_writer(self, inputs, types, fmt=JSON_FORMAT):
         tub_path = self.create_tub_path()
-        tw = TubWriter(path=tub_path, inputs=inputs, types=types)
+        tw = TubWriter(path=tub_path, inputs=inputs, types=types, fmt=fmt)
+        return tw
+
+    def new_async_tub_writer(self, inputs, types, fmt=JSON_FORMAT, queue_size=100, backpressure=DROP_OLDEST):
+        """ The returned part has to be added to the vehicle with threaded=True. """
+        tub_path = self.create_tub_path()
+        tw = AsyncTubWriter(path=tub_path, inputs=inputs, types=types, fmt=fmt,
+                            queue_size=queue_size, backpressure=backpressure)
         return tw
 
 
@@ -561,7 +924,7 @@ class TubTimeStacker(TubImageStacker):
 
                 # load only the first image saved as separate files
                 if typ == 'image' and i == 0:
-                    val = Image.open(os.path.join(self.path, val))
+                    val = Image.open(open_blob(os.path.join(self.path, val)))
                     data[key] = val
                 elif typ == 'image_array' and i == 0:
                     d = super(TubTimeStacker, self).get_record(ix)
@@ -589,6 +952,7 @@ class TubGroup(Tub):
         print('TubGroup:tubpaths:', tub_paths)
         self.tubs = [Tub(path) for path in tub_paths]
         self.input_types = {}
+        self.frames = {}
 
         record_count = 0
         for t in self.tubs:
@@ -596,14 +960,29 @@ class TubGroup(Tub):
             record_count += len(t.df)
             self.input_types.update(dict(zip(t.inputs, t.types)))
 
-        print('joining the tubs {} records together. This could take {} minutes.'
-              .format(record_count, round(float(record_count / 300000), 1)))
+        print('joining the tubs {} records together.'.format(record_count))
 
         self.meta = {'inputs': list(self.input_types.keys()),
                      'types': list(self.input_types.values())}
 
         # 把各个tub的df加起来
-        self.df = pd.concat([t.df for t in self.tubs], axis=0, join='inner')
+        self.df = pd.concat([t.df for t in self.tubs], axis=0, join='inner', ignore_index=True)
+
+    def materialize(self, frame_cache, key='cam/image_array'):
+        for t in self.tubs:
+            t.materialize(frame_cache, key)
+
+    def frame_segments(self, key):
+        # the rows of each tub follow each other in the joined DataFrame
+        segments = []
+        start = 0
+        for t in self.tubs:
+            tub_segments = t.frame_segments(key)
+            if tub_segments is None:
+                return None
+            segments += [(start + s, frames) for s, frames in tub_segments]
+            start += len(t.df)
+        return segments
 
     def expand_path_mask(self, path):
         matches = []
@@ -620,3 +999,64 @@ class TubGroup(Tub):
             paths = self.expand_path_mask(path)
             expanded_paths += paths
         return expanded_paths
+
+
+
+def convert_tub(path, remove_legacy=True):
+    """
+    Rewrite a tub stored as one json file per record into the log format.
+
+    The conversion happens in place. meta.json is only switched to the log
+    format once every record has been appended, so an interrupted conversion
+    leaves a readable json tub behind and can simply be run again.
+    """
+    tub = Tub(path)
+    if tub.format == LOG_FORMAT:
+        logger.info('Tub is already in the log format: {}'.format(tub.path))
+        return tub
+
+    index = tub.get_index(shuffled=False)
+    tub.shutdown()
+
+    # the json index, the record cache and leftovers of an interrupted conversion
+    for file_name in os.listdir(tub.path):
+        if is_log_file(file_name) or file_name == DF_CACHE_FILE:
+            os.unlink(os.path.join(tub.path, file_name))
+
+    logger.info('Converting tub {} with {} records'.format(tub.path, len(index)))
+    tub_log = TubLog(tub.path)
+    legacy_files = []
+    for ix in index:
+        record_path = tub.get_json_record_path(ix)
+        with open(record_path, 'r') as fp:
+            json_data = json.load(fp)
+
+        blobs = {}
+        for key, val in json_data.items():
+            if tub.get_input_type(key) in ['image', 'image_array']:
+                file_path = os.path.join(tub.path, val)
+                with open(file_path, 'rb') as fp:
+                    blobs[key] = fp.read()
+                legacy_files.append(file_path)
+
+        tub_log.append(ix, json_data, blobs)
+        legacy_files.append(record_path)
+    tub_log.close()
+
+    tub.meta['format'] = LOG_FORMAT
+    tmp_path = tub.meta_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(tub.meta, f)
+    os.replace(tmp_path, tub.meta_path)
+
+    if remove_legacy:
+        for file_path in legacy_files:
+            os.unlink(file_path)
+
+    logger.info('Tub converted: {}'.format(tub.path))
+    return Tub(path)
+
+
+if __name__ == '__main__':
+    for tub_path in sys.argv[1:]:
+        convert_tub(tub_path)
@@ -4,28 +4,100 @@ keras.py
 functions to run and train autopilots using keras
 
 """
+import time
 from typing import Optional
+
+import numpy as np
+import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras.layers import Input,Dense
 from tensorflow.keras.layers import Convolution2D
 from tensorflow.keras.layers import Dropout,Flatten,Cropping2D,Lambda
 from tensorflow.keras.models import Model,load_model
 
+from profiler import RecentLatencies
+
+FUNCTION_ENGINE = 'function'
+DIRECT_ENGINE = 'direct'
+ENGINES = (FUNCTION_ENGINE, DIRECT_ENGINE)
+
+
+class InferenceEngine(object):
+    """
+    Runs a model on one frame at a time.
+
+    model.predict builds a dataset and runs callbacks on every call, which
+    costs more than the model itself for a single frame. The 'function'
+    engine traces the model once into a tf.function with a fixed input
+    signature, the 'direct' engine calls the model eagerly. The latency of
+    the last `history` calls is kept for latency_percentiles.
+    """
+
+    def __init__(self, model, mode=FUNCTION_ENGINE, history=1000):
+        if mode not in ENGINES:
+            raise ValueError('Unknown inference engine {}, expected one of {}'.format(mode, ENGINES))
+        self.model = model
+        self.mode = mode
+        self.input_shape = (1,) + tuple(model.input_shape[1:])
+        self.latencies = RecentLatencies(history)
+
+        if mode == FUNCTION_ENGINE:
+            spec = tf.TensorSpec(self.input_shape, tf.float32)
+            self.infer = tf.function(lambda x: model(x, training=False), input_signature=[spec])
+        else:
+            self.infer = lambda x: model(x, training=False)
+
+    def warmup(self, runs=3):
+        """ Trace and run the model a few times so the first frame isn't slow. """
+        x = np.zeros(self.input_shape, dtype=np.float32)
+        for _ in range(runs):
+            self.infer(x)
+
+    def __call__(self, img_arr):
+        x = np.asarray(img_arr, dtype=np.float32).reshape(self.input_shape)
+        start = time.perf_counter()
+        outputs = [o.numpy() for o in tf.nest.flatten(self.infer(x))]
+        self.latencies.record(time.perf_counter() - start)
+        return outputs
+
+    def latency_percentiles(self, percentiles=(50, 90, 99)):
+        """ {percentile: latency in ms} of the recent calls """
+        return self.latencies.percentiles(percentiles)
+
 
 class KerasPilot:
-    def __init__(self) -> None:
+    # objects of the model bucket making up a SavedModel
+    model_files = ['keras_metadata.pb', 'saved_model.pb', 'variables/variables.data-00000-of-00001',
+                   'variables/variables.index']
+
+    def __init__(self, engine=FUNCTION_ENGINE) -> None:
         self.model: Optional[Model] = None
         self.optimizer = "adam"
+        self.engine_mode = engine
+        self.engine: Optional[InferenceEngine] = None
 
     def load(self, model_path: str) -> None:
         self.model = load_model(model_path)
+        self.engine = None
+        self.get_engine()
+
+    def get_engine(self) -> InferenceEngine:
+        """ The engine running self.model, created and warmed up on first use """
+        if self.engine is None or self.engine.model is not self.model:
+            self.engine = InferenceEngine(self.model, mode=self.engine_mode)
+            self.engine.warmup()
+        return self.engine
+
+    def latency_percentiles(self):
+        return self.engine.latency_percentiles() if self.engine is not None else {}
 
     def _get_train_model(self) -> Model:
         """ Model used for training, could be just a sub part of the model"""
         return self.model
 
     def shutdown(self):
-            pass
+        if self.engine is not None:
+            self.engine.latencies.log()
 
     def compile(self) -> None:
         pass
@@ -70,17 +142,15 @@ class KerasPilot:
 
 
 class KerasLinear(KerasPilot):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, engine=FUNCTION_ENGINE):
+        super().__init__(engine=engine)
         self.model = default_linear()
 
     def compile(self) -> None:
         self.model.compile(optimizer=self.optimizer,loss='mse')
 
     def run(self,img_arr):
-        img_arr = img_arr.reshape((1,) + img_arr.shape)
-        outputs = self.model.predict(img_arr)
-        # print(len(outputs),outputs)
+        outputs = self.get_engine()(img_arr)
         steering = outputs[0]
         throttle = outputs[1]
         return steering[0][0], throttle[0][0]
@@ -2,6 +2,8 @@ from minio import Minio
 from minio.error import InvalidResponseError
 import os
 from log import get_logger
+from parts.transfer import CHUNK_SIZE, ThrottledReader
+from parts.tublog import RecordIndex, INDEX_FILE
 
 logger = get_logger(__name__)
 
@@ -19,12 +21,22 @@ class UpAndDownload(object):
                 targetDir.append(dir)
         return targetDir
 
-    def upload_data(self):
+    def upload_data(self, job=None):
+        """
+        Upload the tubs with enough records, each to a bucket of its own.
+        job: a TransferJob to report the progress to, see transfer.py.
+        """
+        uploads = []
         targetDir = self.get_dir_base_on_prefix(self.path, prefix="tub")
         for bucket in targetDir:
             location = "use-east-1"
             result = os.listdir(os.path.join(self.path, bucket))
-            if len(result) < 1000:
+            if INDEX_FILE in result:
+                # json tubs have two files per record, log tubs only a few in total
+                index = RecordIndex(os.path.join(self.path, bucket, INDEX_FILE))
+                if index.count < 500:
+                    continue
+            elif len(result) < 1000:
                 continue
             new_bucket_name = bucket.replace('_', '-')
             exist = self.client.bucket_exists(bucket_name=new_bucket_name)
@@ -33,22 +45,70 @@ class UpAndDownload(object):
                 # print('bucket {} has already been.'.format(new_bucket_name))
                 logger.info('Bucket {} has already been.'.format(bucket))
             else:
-                self.client.make_bucket(bucket_name=new_bucket_name)
-                logger.info("Bucket {} Successfully created ".format(bucket))
-                # print('bucket {} successfully create has already been.'.format(new_bucket_name))
                 targetObjects = self.get_dir_base_on_prefix(os.path.join(self.path, bucket), "")
-                for object_name in targetObjects:
-                    object_path = os.path.join(self.path, bucket, object_name)
-                    self.client.fput_object(bucket_name=new_bucket_name, object_name=object_name, file_path=object_path)
+                uploads.append((new_bucket_name, [(object_name, os.path.join(self.path, bucket, object_name))
+                                                  for object_name in targetObjects]))
 
-    def download_data(self,bucket_name,object_name):
+        if job is not None:
+            for _, objects in uploads:
+                for _, object_path in objects:
+                    job.add_total(os.path.getsize(object_path))
+        for bucket_name, objects in uploads:
+            # made just before its upload, so a failed or cancelled job leaves no empty buckets behind
+            if job is not None:
+                job.check()
+            self.client.make_bucket(bucket_name=bucket_name)
+            logger.info("Bucket {} Successfully created ".format(bucket_name))
+            try:
+                for object_name, object_path in objects:
+                    self.put_file(bucket_name, object_name, object_path, job)
+            except BaseException:
+                # an existing bucket counts as uploaded, so don't leave a partial one
+                logger.warning('Upload to bucket {} stopped, removing it'.format(bucket_name))
+                self.delete_bucket(bucket_name)
+                raise
+
+    def put_file(self, bucket_name, object_name, file_path, job=None):
+        if job is None:
+            self.client.fput_object(bucket_name=bucket_name, object_name=object_name, file_path=file_path)
+            return
+        with open(file_path, 'rb') as fp:
+            self.client.put_object(bucket_name=bucket_name, object_name=object_name,
+                                   data=ThrottledReader(fp, job), length=os.path.getsize(file_path))
+        job.file_done()
+
+    def download_data(self,bucket_name,object_name, job=None):
         exist = self.client.bucket_exists(bucket_name)
         if exist :
-            self.client.fget_object(bucket_name,object_name,os.path.join(self.path,bucket_name,object_name))
+            self.get_file(bucket_name, object_name, os.path.join(self.path, bucket_name, object_name), job)
             logger.info("Object {} has downloaded successfully".format(object_name))
         else :
             logger.error("Bucket {} does not exist".format(bucket_name))
 
+    def get_file(self, bucket_name, object_name, file_path, job=None):
+        if job is None:
+            self.client.fget_object(bucket_name, object_name, file_path)
+            return
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        # like fget_object, the file only replaces the old one when complete
+        part_path = file_path + '.part'
+        response = self.client.get_object(bucket_name, object_name)
+        try:
+            job.add_total(int(response.headers.get('Content-Length', 0)))
+            with open(part_path, 'wb') as fp:
+                for data in response.stream(CHUNK_SIZE):
+                    job.advance(len(data))
+                    fp.write(data)
+        except BaseException:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        finally:
+            response.close()
+            response.release_conn()
+        os.replace(part_path, file_path)
+        job.file_done()
+
 
     def delete_bucket(self, bucket_name):
         objectlist = self.client.list_objects(bucket_name=bucket_name)
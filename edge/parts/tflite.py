@@ -0,0 +1,118 @@
+"""
+tflite.py
+
+Run autopilots exported to TensorFlow Lite by the training service.
+
+Only the small tflite_runtime package is needed on the car. tensorflow is
+imported when it is missing, and only when a model is loaded.
+
+"""
+import os
+import time
+
+import numpy as np
+
+from log import get_logger
+from profiler import RecentLatencies
+
+logger = get_logger(__name__)
+
+TFLITE_FILE = 'model.tflite'
+
+
+def load_interpreter(model_path, num_threads=None):
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        logger.info('tflite_runtime is not installed, using tensorflow.lite')
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+    return Interpreter(model_path=model_path, num_threads=num_threads)
+
+
+def output_indices(interpreter, names):
+    """
+    Tensor indices of the model outputs in the order of names. The output
+    details of the interpreter are not in the order of the keras outputs,
+    so they are looked up in the signature, which keeps the keras output
+    names or numbers them in order.
+    """
+    try:
+        outputs = interpreter.get_signature_runner().get_output_details()
+    except (AttributeError, ValueError):
+        outputs = {}
+    if all(name in outputs for name in names):
+        return [outputs[name]['index'] for name in names]
+    if outputs:
+        return [outputs[name]['index'] for name in sorted(outputs, key=lambda n: (len(n), n))]
+    return [d['index'] for d in sorted(interpreter.get_output_details(), key=lambda d: d['name'])]
+
+
+class TFLitePilot(object):
+    """
+    A pilot part running a .tflite model, with the run(img_arr) contract of
+    KerasLinear: returns the angle and the throttle of one camera frame.
+
+    Quantized inputs and outputs of int8 models are converted from and to
+    float here, so the part works the same for float and int8 exports.
+    """
+
+    model_files = [TFLITE_FILE]
+
+    def __init__(self, num_threads=None, outputs=('angle_out', 'throttle_out'), history=1000):
+        self.num_threads = num_threads
+        self.output_names = list(outputs)
+        # (interpreter, input details, output details), replaced as a whole
+        # by load so run never mixes a new interpreter with old details
+        self.model = None
+        self.latencies = RecentLatencies(history)
+
+    def load(self, model_path):
+        """ model_path: a .tflite file or the model directory containing one """
+        if os.path.isdir(model_path):
+            model_path = os.path.join(model_path, TFLITE_FILE)
+        interpreter = load_interpreter(model_path, self.num_threads)
+        interpreter.allocate_tensors()
+
+        details = {d['index']: d for d in interpreter.get_output_details()}
+        model = (interpreter, interpreter.get_input_details()[0],
+                 [details[i] for i in output_indices(interpreter, self.output_names)])
+        logger.info('Loaded {} with {} input'.format(model_path, np.dtype(model[1]['dtype']).name))
+
+        # the first invoke prepares the kernels, done before the drive loop sees the model
+        self.infer(model, np.zeros(model[1]['shape'][1:], dtype=np.float32))
+        self.model = model
+
+    def quantize(self, input_details, img_arr):
+        dtype = input_details['dtype']
+        x = np.asarray(img_arr, dtype=np.float32).reshape(input_details['shape'])
+        if dtype == np.float32:
+            return x
+        scale, zero_point = input_details['quantization']
+        info = np.iinfo(dtype)
+        return np.clip(np.round(x / scale + zero_point), info.min, info.max).astype(dtype)
+
+    def dequantize(self, output, value):
+        scale, zero_point = output['quantization']
+        if scale:
+            return (float(value) - zero_point) * scale
+        return value
+
+    def infer(self, model, img_arr):
+        interpreter, input_details, outputs = model
+        interpreter.set_tensor(input_details['index'], self.quantize(input_details, img_arr))
+        interpreter.invoke()
+        return tuple(self.dequantize(o, interpreter.get_tensor(o['index'])[0][0]) for o in outputs)
+
+    def run(self, img_arr):
+        start = time.perf_counter()
+        angle, throttle = self.infer(self.model, img_arr)
+        self.latencies.record(time.perf_counter() - start)
+        return angle, throttle
+
+    def latency_percentiles(self, percentiles=(50, 90, 99)):
+        """ {percentile: latency in ms} of the recent calls """
+        return self.latencies.percentiles(percentiles)
+
+    def shutdown(self):
+        self.latencies.log()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+transfer.py
+
+Uploads and downloads running on a thread pool of their own, so a long
+transfer doesn't hold the IOLoop serving the controls and the video. Each
+transfer is a TransferJob reporting its progress, which can be cancelled.
+All jobs share one bandwidth limit, to leave room on the link for driving.
+"""
+import collections
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from log import get_logger
+
+logger = get_logger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class TransferCancelled(Exception):
+    pass
+
+
+class BandwidthLimit(object):
+    """
+    A token bucket of bytes_per_sec, holding at most a quarter second worth
+    of bytes, so a transfer starts without a long burst. 0 or None doesn't
+    limit.
+    """
+
+    def __init__(self, bytes_per_sec):
+        self.rate = bytes_per_sec
+        self.burst = (bytes_per_sec or 0) / 4.0
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, nbytes):
+        """ Take nbytes from the bucket, returns the seconds to wait before sending them. """
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= nbytes
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class TransferJob(object):
+    """
+    The progress of a transfer. The worker running it adds the bytes it
+    is going to move to total as it finds them and reports the bytes moved
+    with advance, which also waits for the bandwidth limit and raises
+    TransferCancelled once the job is cancelled.
+    """
+
+    def __init__(self, job_id, kind, limit=None):
+        self.id = job_id
+        self.kind = kind
+        self.limit = limit
+        self.state = QUEUED
+        self.total = 0
+        self.done = 0
+        self.files = 0
+        self.files_done = 0
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancelled = threading.Event()
+
+    def add_total(self, nbytes, files=1):
+        self.total += nbytes
+        self.files += files
+
+    def advance(self, nbytes):
+        self.check()
+        self.done += nbytes
+        delay = self.limit.reserve(nbytes) if self.limit is not None else 0.0
+        if delay and self.cancelled.wait(delay):
+            raise TransferCancelled()
+
+    def file_done(self):
+        self.files_done += 1
+
+    def check(self):
+        if self.cancelled.is_set():
+            raise TransferCancelled()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    @property
+    def active(self):
+        return self.state in (QUEUED, RUNNING)
+
+    def throughput(self):
+        """ bytes per second since the job started """
+        if self.started is None:
+            return 0.0
+        elapsed = (self.finished or time.time()) - self.started
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def to_dict(self):
+        return {'id': self.id,
+                'kind': self.kind,
+                'state': self.state,
+                'bytes': self.done,
+                'total_bytes': self.total,
+                'files': self.files_done,
+                'total_files': self.files,
+                'progress': self.done / self.total if self.total else None,
+                'throughput': self.throughput(),
+                'created': self.created,
+                'started': self.started,
+                'finished': self.finished,
+                'error': self.error}
+
+
+class ThrottledReader(object):
+    """ A file object for uploads that reports every read to its job. """
+
+    def __init__(self, fp, job):
+        self.fp = fp
+        self.job = job
+
+    def read(self, size=-1):
+        # read in chunks, so the limit and cancelling act within a file
+        chunks = []
+        while size != 0:
+            data = self.fp.read(CHUNK_SIZE if size is None or size < 0 else min(size, CHUNK_SIZE))
+            if not data:
+                break
+            self.job.advance(len(data))
+            chunks.append(data)
+            if size is not None and size > 0:
+                size -= len(data)
+        return b''.join(chunks)
+
+
+class JobRunner(object):
+    """
+    Runs transfer functions as jobs on `workers` threads. fn(job, *args)
+    gets the job to report to. Only one job of a kind is active at a time,
+    submitting another returns the active one. The last `history` finished
+    jobs are kept for /jobs.
+    """
+
+    def __init__(self, workers=1, bytes_per_sec=None, history=20):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='transfer')
+        self.limit = BandwidthLimit(bytes_per_sec)
+        self.history = history
+        self.jobs = collections.OrderedDict()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def submit(self, kind, fn, *args):
+        with self.lock:
+            for job in self.jobs.values():
+                if job.kind == kind and job.active:
+                    return job
+            job = TransferJob(next(self.ids), kind, self.limit)
+            self.jobs[job.id] = job
+            finished = [j.id for j in self.jobs.values() if not j.active]
+            for job_id in finished[:max(0, len(finished) - self.history)]:
+                del self.jobs[job_id]
+        self.executor.submit(self.run, job, fn, args)
+        return job
+
+    def run(self, job, fn, args):
+        job.started = time.time()
+        try:
+            job.check()
+            job.state = RUNNING
+            fn(job, *args)
+            job.state = DONE
+        except TransferCancelled:
+            job.state = CANCELLED
+        except Exception as e:
+            logger.exception('Transfer job {} ({}) failed'.format(job.id, job.kind))
+            job.error = str(e)
+            job.state = FAILED
+        finally:
+            job.finished = time.time()
+        logger.info('Transfer job {} ({}) {}: {} bytes in {} files, {:.0f}KB/s'.format(
+            job.id, job.kind, job.state, job.done, job.files_done, job.throughput() / 1024))
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def list(self):
+        return list(self.jobs.values())
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is not None:
+            job.cancel()
+        return job
+
+    def shutdown(self):
+        for job in self.list():
+            job.cancel()
+        self.executor.shutdown(wait=False)
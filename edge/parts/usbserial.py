@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
+import time
 
-import serial
 import numpy as np
 
 
@@ -27,8 +27,12 @@ class CarEngine:
     left_pulse = -100
     right_pulse = 100
 
-    def __init__(self, dev='/dev/ttyUSB0'):
-        self.port = serial.Serial(dev, 115200, timeout=1)
+    def __init__(self, dev='/dev/ttyUSB0', port=None):
+        """ port: an open serial port to use instead of opening dev, like FakeSerial """
+        if port is None:
+            import serial
+            port = serial.Serial(dev, 115200, timeout=1)
+        self.port = port
 
     def run(self, angle, throttle):
         # map absolute angle to angle that vehicle can implement.
@@ -76,6 +80,36 @@ class CarEngine:
         self.port.close()
 
 
+class FakeSerial:
+    """
+    Stands in for the serial port of CarEngine without a car attached. It
+    keeps the last command written and when it was written, so benchmarks
+    can time the actuation.
+    """
+
+    def __init__(self, write_delay=0.0):
+        # seconds a write blocks, a 12 byte command takes ~1ms at 115200 baud
+        # when the driver doesn't buffer it
+        self.write_delay = write_delay
+        self.writes = 0
+        self.last_command = None
+        self.last_write_time = None
+        self.is_open = True
+
+    def write(self, data):
+        if not self.is_open:
+            raise IOError('write to a closed FakeSerial')
+        if self.write_delay:
+            time.sleep(self.write_delay)
+        self.last_command = bytes(data)
+        self.last_write_time = time.perf_counter()
+        self.writes += 1
+        return len(self.last_command)
+
+    def close(self):
+        self.is_open = False
+
+
 if __name__ == '__main__':
     engine = CarEngine(dev='/dev/cu.usbserial-14210')
     engine._move(0.2, -0.2, 0.2, -0.2)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+cloud.py
+
+Calls to the training service that don't block the IOLoop serving the
+controls and the video.
+"""
+import asyncio
+import json
+import time
+from urllib.parse import urlencode
+
+import tornado.httpclient
+
+from log import get_logger
+
+logger = get_logger(__name__)
+
+CONNECT_TIMEOUT = 5  # seconds
+
+
+def make_http_client(max_clients=4):
+    """
+    A client of its own for the cloud requests, so they don't queue behind
+    other users of the shared AsyncHTTPClient. The curl client, when pycurl
+    is installed, keeps the connections to the cloud alive between
+    requests, the simple client reconnects for every request.
+    """
+    try:
+        from tornado.curl_httpclient import CurlAsyncHTTPClient
+    except ImportError:
+        logger.info('pycurl is not installed, cloud requests open a connection each')
+        return tornado.httpclient.AsyncHTTPClient(force_instance=True, max_clients=max_clients)
+    return CurlAsyncHTTPClient(force_instance=True, max_clients=max_clients)
+
+
+class CloudError(Exception):
+    pass
+
+
+class CloudClient(object):
+    """
+    The /train and /status calls of the training service.
+
+    The last status of the task is kept for status_max_age seconds and
+    status polls in that time are answered from it. Polls arriving while
+    the status is fetched wait for that request instead of sending their
+    own. When the service can't be reached, the last known status is
+    returned, marked 'stale'.
+    """
+
+    def __init__(self, base_url, timeout=30, status_max_age=5):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.status_max_age = status_max_age
+        self.status = None  # (task id, response body)
+        self.status_time = 0.0
+        self.refresh = None
+        # made on the IOLoop it is used on
+        self.http_client = None
+
+    async def post(self, path, data):
+        request = tornado.httpclient.HTTPRequest(
+            self.base_url + '/' + path, method='POST', body=urlencode(data),
+            connect_timeout=CONNECT_TIMEOUT, request_timeout=self.timeout)
+        if self.http_client is None:
+            self.http_client = make_http_client()
+        try:
+            response = await self.http_client.fetch(request)
+        except (tornado.httpclient.HTTPError, OSError) as e:
+            raise CloudError('POST {} failed: {}'.format(request.url, e))
+        return response.body
+
+    async def train(self, data_path):
+        """ The response body, with the task_id of the training started. """
+        return await self.post('train', {'data_path': data_path})
+
+    async def task_status(self, task_id):
+        """ The response body of /status for task_id, maybe from the cache. """
+        status = self.status
+        if status is not None and status[0] == task_id and \
+                time.monotonic() - self.status_time < self.status_max_age:
+            return status[1]
+        if self.refresh is None:
+            self.refresh = asyncio.ensure_future(self.fetch_status(task_id))
+        return await asyncio.shield(self.refresh)
+
+    async def fetch_status(self, task_id):
+        try:
+            body = await self.post('status', {'task_id': task_id})
+        except CloudError as e:
+            status = self.status
+            if status is None or status[0] != task_id:
+                raise
+            logger.warning('{}, returning the last known status'.format(e))
+            return json.dumps(dict(json.loads(status[1]), stale=True))
+        finally:
+            self.refresh = None
+        self.status = (task_id, body)
+        self.status_time = time.monotonic()
+        return body
+
+    def forget(self):
+        """ Drop the cached status, once its task is done. """
+        self.status = None
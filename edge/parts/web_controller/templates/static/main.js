@@ -34,12 +34,18 @@ var driveHandler = new function() {
     var vehicle_id = ""
     var driveURL = ""
     var vehicleURL = ""
+    var controlSocket = null;
+    var controlSeq = 0;
+    var controlSentAt = {};
+    // the order of DRIVE_MODES in web.py
+    var driveModes = ['user', 'local_angle', 'local'];
 
     this.load = function() {
       driveURL = '/drive'
       vehicleURL = '/drive'
 
       setBindings()
+      openControlSocket()
 
       joystick_options = {
         zone: document.getElementById('joystick_container'),  // active zone
@@ -282,15 +288,60 @@ var driveHandler = new function() {
       //drawLine(state.tele.user.angle, state.tele.user.throttle)
     };
 
+    // Send the controls over a WebSocket when the browser and the car can,
+    // postDrive falls back to a POST per update while it is not open.
+    var openControlSocket = function() {
+      if (!window.WebSocket || !window.DataView) {
+        return;
+      }
+      var scheme = location.protocol == 'https:' ? 'wss://' : 'ws://';
+      var ws = new WebSocket(scheme + location.host + driveURL + '/ws');
+      ws.binaryType = 'arraybuffer';
+      ws.onopen = function() {
+        controlSocket = ws;
+      };
+      ws.onmessage = function(event) {
+        var tele = JSON.parse(event.data);
+        if (tele.seq in controlSentAt) {
+          state.lag = Date.now() - controlSentAt[tele.seq];
+          controlSentAt = {};
+        }
+      };
+      ws.onclose = function() {
+        controlSocket = null;
+        setTimeout(openControlSocket, 2000);
+      };
+    };
+
+    var sendControl = function() {
+        var mode = driveModes.indexOf(state.driveMode);
+        if (controlSocket === null || controlSocket.readyState !== WebSocket.OPEN || mode < 0) {
+          return false;
+        }
+        // CONTROL_FRAME in web.py
+        var frame = new DataView(new ArrayBuffer(16));
+        controlSeq = (controlSeq + 1) >>> 0;
+        frame.setUint32(0, controlSeq, true);
+        frame.setFloat32(4, state.tele.user.angle, true);
+        frame.setFloat32(8, state.tele.user.throttle, true);
+        frame.setUint8(12, mode);
+        frame.setUint8(13, state.recording ? 1 : 0);
+        controlSocket.send(frame.buffer);
+        controlSentAt[controlSeq] = Date.now();
+        return true;
+    };
+
     var postDrive = function() {
 
         //Send angle and throttle values
-        data = JSON.stringify({ 'angle': state.tele.user.angle,
-                                'throttle':state.tele.user.throttle,
-                                'drive_mode':state.driveMode,
-                                'recording': state.recording})
-        console.log(data)
-        $.post(driveURL, data)
+        if (!sendControl()) {
+          data = JSON.stringify({ 'angle': state.tele.user.angle,
+                                  'throttle':state.tele.user.throttle,
+                                  'drive_mode':state.driveMode,
+                                  'recording': state.recording})
+          console.log(data)
+          $.post(driveURL, data)
+        }
         updateUI()
     };
 
@@ -335,15 +386,30 @@ var driveHandler = new function() {
     }
     
     
+    // uploads and downloads run in the background, poll their job until it ends
+    var watchJob = function (job, message) {
+        var timer = setInterval(function () {
+            $.get('jobs/' + job.id, function (job) {
+                if (job.state == 'done') {
+                    clearInterval(timer);
+                    alert(message);
+                } else if (job.state == 'failed' || job.state == 'cancelled') {
+                    clearInterval(timer);
+                    alert(job.state + ": " + (job.error || ""));
+                }
+            })
+        }, 2000)
+    }
+
     var postUpload = function () {
-        $.post('upload',function(data,status){
-            if(status == "success"){alert("上传成功！");}
+        $.post('upload',function(job,status){
+            if(status == "success"){watchJob(job, "上传成功！");}
             })
     }
 
     var postDownload= function () {
-        $.post('download',function(data,status){
-            if(status == "success"){alert("下载成功！");}
+        $.post('download',function(job,status){
+            if(status == "success"){watchJob(job, "下载成功！");}
             })
     }
 
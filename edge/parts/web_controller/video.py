@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+video.py
+
+Fans the camera frames out to the clients of the MJPEG stream, encoding
+each frame once per size and quality asked for however many clients watch
+it.
+"""
+import struct
+
+from PIL import Image
+import tornado.ioloop
+import tornado.locks
+
+import utils
+from log import get_logger
+
+logger = get_logger(__name__)
+
+
+def encode_frame(frame, scale=1.0, quality=75):
+    """ JPEG bytes of the frame resized by scale """
+    img = utils.arr_to_img(frame)
+    if scale != 1.0:
+        size = (max(1, int(round(img.width * scale))), max(1, int(round(img.height * scale))))
+        img = img.resize(size, Image.BILINEAR)
+    return utils.img_to_binary(img, quality=quality)
+
+
+def unsent_bytes(stream):
+    """
+    Bytes of an IOStream the peer has not acknowledged yet, from the
+    socket's send queue. None where the OS doesn't tell, Linux does.
+    """
+    try:
+        import fcntl
+        import termios
+        queued = fcntl.ioctl(stream.socket.fileno(), termios.TIOCOUTQ, b'\0' * 4)
+    except (ImportError, AttributeError, OSError):
+        return None
+    return struct.unpack('i', queued)[0]
+
+
+class StreamQuality(object):
+    """
+    The JPEG quality and frame rate of one stream, at most those the client
+    asked for.
+
+    With adaptive, a frame finding the previous one still being written to
+    the socket, or more than BACKLOG_FRAMES frames in the socket's send
+    queue, means the link can't keep up. That lowers the quality by
+    QUALITY_STEP down to MIN_QUALITY, then halves the frame rate down to
+    MIN_FPS. After RECOVER_FRAMES frames in a row written in time the frame
+    rate, then the quality, go back up.
+    """
+
+    BACKLOG_FRAMES = 2
+    QUALITY_STEP = 10
+    MIN_QUALITY = 20
+    MIN_FPS = 2
+    RECOVER_FRAMES = 30
+
+    def __init__(self, quality, max_fps, adaptive=False):
+        self.max_quality = quality
+        self.quality = quality
+        self.max_fps = max_fps
+        self.fps = max_fps
+        self.adaptive = adaptive
+        self.in_time = 0
+
+    def congested(self):
+        self.in_time = 0
+        if not self.adaptive:
+            return
+        if self.quality > self.MIN_QUALITY:
+            self.quality = max(self.MIN_QUALITY, self.quality - self.QUALITY_STEP)
+        else:
+            self.fps = max(self.MIN_FPS, self.fps / 2.0)
+
+    def written_in_time(self):
+        self.in_time += 1
+        if not self.adaptive or self.in_time < self.RECOVER_FRAMES:
+            return
+        self.in_time = 0
+        if self.fps < self.max_fps:
+            self.fps = min(self.max_fps, self.fps * 2.0)
+        elif self.quality < self.max_quality:
+            self.quality = min(self.max_quality, self.quality + self.QUALITY_STEP)
+
+    def interval(self):
+        """ seconds between frames """
+        return 1.0 / self.fps
+
+
+class FrameSubscriber(object):
+    """
+    What one client of the stream gets sent next: only the latest encoded
+    frame. A frame arriving before the client took the previous one
+    replaces it, so a slow client drops frames instead of falling behind.
+    variant is the (scale, quality) the frames are encoded with.
+    """
+
+    def __init__(self, variant):
+        self.variant = variant
+        self.pending = None
+        self.frame_id = 0
+        self.ready = tornado.locks.Event()
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+
+    def offer(self, frame_id, jpeg):
+        if self.pending is not None:
+            self.dropped += 1
+        self.pending = (frame_id, jpeg)
+        self.frame_id = frame_id
+        self.ready.set()
+
+    async def next(self):
+        """ (frame id, jpeg bytes) of the latest frame, None once the client is gone """
+        await self.ready.wait()
+        return self.take()
+
+    def take(self):
+        """ The frame next would return if there is one, without waiting """
+        self.ready.clear()
+        if self.closed or self.pending is None:
+            return None
+        item, self.pending = self.pending, None
+        return item
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+
+class FrameBroadcaster(object):
+    """
+    The vehicle publishes every frame, from any thread, which only keeps a
+    reference to it. While clients are subscribed, a task on the IOLoop
+    encodes each new frame once for every variant the subscribers ask for,
+    in the default executor so the IOLoop keeps serving, and offers the
+    bytes to the subscribers of the variant. A frame is new when it is not
+    the object published last, frames aren't compared.
+    """
+
+    def __init__(self, encode=encode_frame):
+        self.encode = encode
+        # (frame id, frame), replaced as a whole so a reader never sees
+        # the id of one frame with another
+        self.latest = (0, None)
+        # variant: (frame id, jpeg bytes)
+        self.jpegs = {}
+        self.encoded = 0
+        self.subscribers = set()
+        self.io_loop = None
+        self.new_frame = None
+        self.pumping = False
+
+    def publish(self, frame):
+        frame_id, last = self.latest
+        if frame is None or frame is last:
+            return
+        self.latest = (frame_id + 1, frame)
+        if self.subscribers:
+            # add_callback is the only IOLoop method safe to call from other threads
+            self.io_loop.add_callback(self.new_frame.set)
+
+    def subscribe(self, variant=(1.0, 75)):
+        """ A FrameSubscriber for a new client, called on the IOLoop. """
+        if self.io_loop is None:
+            self.io_loop = tornado.ioloop.IOLoop.current()
+            self.new_frame = tornado.locks.Event()
+        subscriber = FrameSubscriber(variant)
+        self.subscribers.add(subscriber)
+        self.new_frame.set()
+        if not self.pumping:
+            self.pumping = True
+            self.io_loop.spawn_callback(self.pump)
+        return subscriber
+
+    def set_variant(self, subscriber, variant):
+        """ Encode the next frames of subscriber with another (scale, quality) """
+        if variant != subscriber.variant:
+            subscriber.variant = variant
+            self.new_frame.set()
+
+    def unsubscribe(self, subscriber):
+        subscriber.close()
+        if subscriber in self.subscribers:
+            self.subscribers.discard(subscriber)
+            logger.info('Video client left after {} frames, {} dropped as it was slow'.format(
+                subscriber.sent, subscriber.dropped))
+
+    async def pump(self):
+        try:
+            while self.subscribers:
+                await self.new_frame.wait()
+                self.new_frame.clear()
+                frame_id, frame = self.latest
+                if frame is None:
+                    continue
+                variants = {subscriber.variant for subscriber in self.subscribers}
+                for variant in list(self.jpegs):
+                    if variant not in variants:
+                        del self.jpegs[variant]
+                for variant in variants:
+                    if self.jpegs.get(variant, (None,))[0] != frame_id:
+                        jpeg = await self.io_loop.run_in_executor(None, self.encode, frame, *variant)
+                        self.jpegs[variant] = (frame_id, jpeg)
+                        self.encoded += 1
+                for subscriber in self.subscribers:
+                    cached = self.jpegs.get(subscriber.variant)
+                    if cached is not None and cached[0] == frame_id and subscriber.frame_id != frame_id:
+                        subscriber.offer(*cached)
+        finally:
+            self.pumping = False
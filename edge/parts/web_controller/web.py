@@ -13,6 +13,7 @@ import os
 import os.path
 import time
 import json
+import struct
 from config import load_config
 
 import tornado.httpserver
@@ -20,16 +21,27 @@ import tornado
 import tornado.ioloop
 import tornado.web
 import tornado.gen
-import utils
-import requests
+import tornado.websocket
 from parts.miniostore import UpAndDownload
+from parts.transfer import JobRunner
+from log import get_logger
+from parts.web_controller.cloud import CloudClient, CloudError
+from parts.web_controller.video import FrameBroadcaster, StreamQuality, unsent_bytes
 import asyncio
 
+logger = get_logger(__name__)
+
+# control frames of the /drive/ws socket, little endian: sequence number,
+# angle, throttle, index of the mode in DRIVE_MODES, recording flag
+CONTROL_FRAME = struct.Struct('<Iff2B2x')
+DRIVE_MODES = ('user', 'local_angle', 'local')
+TELEMETRY_INTERVAL = 100  # ms
+
 
 class LocalWebController(tornado.web.Application):
     port = 8887
 
-    def __init__(self,kl=None):
+    def __init__(self,kl=None,vehicle=None):
         """
         Create and publish variables needed on many of
         the web handlers.
@@ -42,11 +54,21 @@ class LocalWebController(tornado.web.Application):
         self.cloud_ip = "http://" + cfg.CLOUD_IP + ":30007"
         self.data_path = cfg.DATA_PATH
         self.task_id = None
+        self.starting_task = False
+        self.cloud = CloudClient(self.cloud_ip, timeout=cfg.CLOUD_TIMEOUT,
+                                 status_max_age=cfg.CLOUD_STATUS_MAX_AGE)
         self.minio_endpoint = cfg.CLOUD_IP +":9000"
         self.access_key = cfg.ACCESS_KEY
         self.secret_key = cfg.SECRET_KEY
         self.minio_client = UpAndDownload(self.data_path,self.minio_endpoint,self.access_key,self.secret_key)
+        self.jobs = JobRunner(workers=cfg.TRANSFER_WORKERS, bytes_per_sec=cfg.TRANSFER_MAX_KBPS * 1024)
         self.kl = kl
+        self.vehicle = vehicle
+        self.video = FrameBroadcaster()
+        self.video_scale = cfg.VIDEO_SCALE
+        self.video_quality = cfg.VIDEO_QUALITY
+        self.video_max_fps = cfg.VIDEO_MAX_FPS or cfg.CAMERA_FRAMERATE
+        self.video_adaptive = cfg.VIDEO_ADAPTIVE
 
         self.angle = 0.0
         self.throttle = 0.0
@@ -61,12 +83,16 @@ class LocalWebController(tornado.web.Application):
         handlers = [
             (r"/", tornado.web.RedirectHandler, dict(url="/drive")),
             (r"/drive", DriveAPI),
+            (r"/drive/ws", DriveSocket),
             (r"/video", VideoAPI),
             (r"/train", TrainAPI),
             (r"/static/(.*)", tornado.web.StaticFileHandler, {"path": self.static_file_path}),
             (r"/upload", UpDataAPI),
             (r"/status", StatusAPI),
             (r"/download",DownloadAPI),
+            (r"/jobs", JobsAPI),
+            (r"/jobs/([0-9]+)", JobsAPI),
+            (r"/stats", VehicleStatsAPI),
         ]
 
         settings = {'debug': True}
@@ -81,29 +107,73 @@ class LocalWebController(tornado.web.Application):
         # instance.add_callback(self.say_hello)
         instance.start()
 
+    async def update_async(self):
+        """
+        Serve on the running event loop, used by Vehicle.run_async instead
+        of update. The handlers then run on the thread of the drive loop.
+        """
+        self.port = int(self.port)
+        self.listen(self.port)
+
     def run_threaded(self, img_arr=None):
         self.img_arr = img_arr
+        self.video.publish(img_arr)
         return self.angle, self.throttle, self.mode, self.recording
 
     def shutdown(self):
-        pass
+        self.jobs.shutdown()
 
 
 class UpDataAPI(tornado.web.RequestHandler):
     def post(self):
+        """ Start uploading the tubs, the job reports the progress at /jobs/<id> """
         up = self.application.minio_client
-        up.upload_data()
+        job = self.application.jobs.submit('upload', up.upload_data)
+        self.write(job.to_dict())
+
+
+def download_model(job, download, kl, model_path):
+    # a keras pilot needs the SavedModel, a tflite pilot only model.tflite
+    for object_name in kl.model_files:
+        download.download_data("model", object_name, job)
+    job.check()
+    kl.load(model_path)
+
 
 class DownloadAPI(tornado.web.RequestHandler):
     def post(self):
-        download = self.application.minio_client
-        download.download_data("model","keras_metadata.pb")
-        download.download_data("model","saved_model.pb")
-        download.download_data("model","variables/variables.data-00000-of-00001")
-        download.download_data("model","variables/variables.index")
-        self.application.kl.load(os.path.join(os.path.expanduser(self.application.data_path),"model"))
+        """ Start downloading the model and load it when complete, see UpDataAPI """
+        app = self.application
+        job = app.jobs.submit('download', download_model, app.minio_client, app.kl,
+                              os.path.join(os.path.expanduser(app.data_path), "model"))
+        self.write(job.to_dict())
+
+
+class JobsAPI(tornado.web.RequestHandler):
+    """ GET the progress of the transfer jobs, or of one, DELETE /jobs/<id> cancels it """
+
+    def get(self, job_id=None):
+        if job_id is None:
+            self.write({'jobs': [job.to_dict() for job in self.application.jobs.list()]})
+            return
+        job = self.application.jobs.get(int(job_id))
+        if job is None:
+            raise tornado.web.HTTPError(404, 'no job {}'.format(job_id))
+        self.write(job.to_dict())
+
+    def delete(self, job_id=None):
+        job = self.application.jobs.cancel(int(job_id)) if job_id is not None else None
+        if job is None:
+            raise tornado.web.HTTPError(404, 'no job {}'.format(job_id))
+        self.write(job.to_dict())
 
 
+class VehicleStatsAPI(tornado.web.RequestHandler):
+    def get(self):
+        """ Timing statistics of the drive loop and its parts, see Vehicle.stats """
+        if self.application.vehicle is None:
+            raise tornado.web.HTTPError(404, 'no vehicle to report on')
+        self.write(self.application.vehicle.stats())
 
 
 class DriveAPI(tornado.web.RequestHandler):
@@ -123,39 +193,101 @@ class DriveAPI(tornado.web.RequestHandler):
         self.application.recording = data['recording']
 
 
+class DriveSocket(tornado.websocket.WebSocketHandler):
+    """
+    The controls of /drive over a WebSocket: binary CONTROL_FRAMEs instead
+    of a POST with JSON per joystick move. Like the POSTs, a frame only
+    sets the controls of the application, so the drive loop coalesces them
+    to the latest. Frames with a sequence number not above the last one
+    are stale and dropped.
+
+    Telemetry goes back as JSON text every TELEMETRY_INTERVAL, with the
+    sequence number of the last control applied so the page can time the
+    round trip. A tick is left out while the previous telemetry is still
+    being sent. When the socket closes the throttle goes to 0, as the
+    driver can't control the car anymore.
+    """
+
+    def open(self):
+        self.last_seq = -1
+        self.dropped = 0
+        self.sending = None
+        self.set_nodelay(True)
+        self.telemetry = tornado.ioloop.PeriodicCallback(self.send_telemetry, TELEMETRY_INTERVAL)
+        self.telemetry.start()
+
+    def on_message(self, message):
+        if not isinstance(message, bytes) or len(message) != CONTROL_FRAME.size:
+            self.close(1003, 'expected {} byte control frames'.format(CONTROL_FRAME.size))
+            return
+        seq, angle, throttle, mode, recording = CONTROL_FRAME.unpack(message)
+        if seq <= self.last_seq:
+            self.dropped += 1
+            return
+        self.last_seq = seq
+        app = self.application
+        app.angle = angle
+        app.throttle = throttle
+        if mode < len(DRIVE_MODES):
+            app.mode = DRIVE_MODES[mode]
+        app.recording = bool(recording)
+
+    def send_telemetry(self):
+        if self.sending is not None and not self.sending.done():
+            return
+        app = self.application
+        data = {'seq': self.last_seq,
+                'angle': app.angle,
+                'throttle': app.throttle,
+                'mode': app.mode,
+                'recording': app.recording}
+        if app.vehicle is not None:
+            data['loops'] = app.vehicle.profiler.loops
+        try:
+            self.sending = self.write_message(json.dumps(data))
+        except tornado.websocket.WebSocketClosedError:
+            self.telemetry.stop()
+
+    def on_close(self):
+        self.telemetry.stop()
+        self.application.throttle = 0.0
+        if self.dropped:
+            logger.info('Control socket closed, {} stale frames dropped'.format(self.dropped))
+
+
 class TrainAPI(tornado.web.RequestHandler):
-    def post(self):
+    async def post(self):
         # data_path = self.get_body_argument("data_path")
         data_path = self.application.data_path
-        if self.application.task_id is not None:
+        if self.application.task_id is not None or self.application.starting_task:
             return self.write("task is running.")
         if data_path is not None:
-            url = os.path.join(self.application.cloud_ip, "train")
-            data = {
-                "data_path": data_path
-            }
-            response = requests.post(url=url, data=data)
-            response_data = json.loads(response.content.decode())
+            self.application.starting_task = True
+            try:
+                content = await self.application.cloud.train(data_path)
+            except CloudError as e:
+                raise tornado.web.HTTPError(502, str(e))
+            finally:
+                self.application.starting_task = False
+            response_data = json.loads(content.decode())
             self.application.task_id = response_data['task_id']
-            return self.write(response.content)
+            return self.write(content)
 
 
 class StatusAPI(tornado.web.RequestHandler):
-    def post(self):
+    async def post(self):
         task_id = self.application.task_id
         if task_id is not None:
-            url = os.path.join(self.application.cloud_ip, "status")
-            data = {
-                "task_id": task_id
-            }
-            response = requests.post(url=url, data=data)
-            response_data = json.loads(response.content.decode())
+            try:
+                content = await self.application.cloud.task_status(task_id)
+            except CloudError as e:
+                raise tornado.web.HTTPError(502, str(e))
+            response_data = json.loads(content)
             state = response_data['state']
-            if state == "SUCCESS":
+            if state in ("SUCCESS", "FAILED") and self.application.task_id == task_id:
                 self.application.task_id = None
-            if state == "FAILED":
-                self.application.task_id = None
-            return self.write(response.content)
+                self.application.cloud.forget()
+            return self.write(content)
         else:
             data = {
                 "state":"not running a task",
@@ -168,33 +300,78 @@ class StatusAPI(tornado.web.RequestHandler):
 class VideoAPI(tornado.web.RequestHandler):
     '''
     Serves a MJPEG of the images posted from the vehicle.
+
+    The query arguments scale (0.1 - 1), quality (10 - 95), fps and
+    adaptive (0 or 1) choose the size, JPEG quality and maximum frame rate
+    of the stream, see StreamQuality for adaptive. They default to the
+    VIDEO_* config.
     '''
 
+    def stream_argument(self, name, default, low, high):
+        value = self.get_argument(name, None)
+        if value is None:
+            return default
+        try:
+            return min(high, max(low, float(value)))
+        except ValueError:
+            raise tornado.web.HTTPError(400, '{} is not a number: {!r}'.format(name, value))
+
     async def get(self):
+        app = self.application
+        scale = self.stream_argument('scale', app.video_scale, 0.1, 1.0)
+        quality = int(self.stream_argument('quality', app.video_quality, 10, 95))
+        max_fps = self.stream_argument('fps', app.video_max_fps, StreamQuality.MIN_FPS, 60)
+        adaptive = bool(self.stream_argument('adaptive', app.video_adaptive, 0, 1))
+        stream = StreamQuality(quality, max_fps, adaptive)
 
         self.set_header("Content-type",
                         "multipart/x-mixed-replace;boundary=--boundarydonotcross")
 
-        served_image_timestamp = time.time()
         my_boundary = "--boundarydonotcross\n"
-        while True:
-
-            interval = .01
-            if served_image_timestamp + interval < time.time() and \
-                    hasattr(self.application, 'img_arr'):
-
-                img = utils.arr_to_binary(self.application.img_arr)
+        self.subscriber = app.video.subscribe((scale, stream.quality))
+        flushing = None
+        sent_time = 0.0
+        try:
+            while True:
+                frame = await self.subscriber.next()
+                if frame is None:
+                    break
+                if flushing is not None and not flushing.done():
+                    # the last frame is still in the stream's write buffer
+                    stream.congested()
+                    await flushing
+                    continue
+                backlog = unsent_bytes(self.request.connection.stream)
+                if backlog is not None and backlog > StreamQuality.BACKLOG_FRAMES * len(frame[1]):
+                    stream.congested()
+                    continue
+                stream.written_in_time()
+                app.video.set_variant(self.subscriber, (scale, stream.quality))
+
+                # a little early, so jitter doesn't halve a stream at the camera's rate
+                wait = sent_time + 0.9 * stream.interval() - time.perf_counter()
+                if wait > 0:
+                    await tornado.gen.sleep(wait)
+                    frame = self.subscriber.take() or frame
+                sent_time = time.perf_counter()
+
+                _, img = frame
                 self.write(my_boundary)
                 self.write("Content-type: image/jpeg\r\n")
                 self.write("Content-length: %s\r\n\r\n" % len(img))
                 self.write(img)
-                served_image_timestamp = time.time()
-                try:
-                    await self.flush()
-                except tornado.iostream.StreamClosedError:
-                    pass
-            else:
-                await tornado.gen.sleep(interval)
+                flushing = self.flush()
+                self.subscriber.sent += 1
+            if flushing is not None:
+                await flushing
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            app.video.unsubscribe(self.subscriber)
+
+    def on_connection_close(self):
+        if hasattr(self, 'subscriber'):
+            self.application.video.unsubscribe(self.subscriber)
 
 
 if __name__ == '__main__':
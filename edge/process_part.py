@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+process_part.py
+
+Run a vehicle part in its own process, so CPU heavy parts don't hold the
+GIL of the drive loop.
+
+The inputs and outputs of the part travel through ring buffers in shared
+memory. Numpy arrays are copied into a slot as raw bytes and only a small
+description of the values is pickled, so camera frames are never pickled.
+"""
+import collections
+import multiprocessing
+import pickle
+import struct
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from log import get_logger
+
+logger = get_logger(__name__)
+
+# sequence number of the latest complete slot
+RING_HEADER = struct.Struct('<q')
+# sequence number when the writer started the slot, when it finished it,
+# length of the pickled description, length of the array bytes
+SLOT_HEADER = struct.Struct('<qqqq')
+SLOT_SIZE = 1024 * 1024
+
+# stands in for an array in the pickled description of the values of a slot
+ArrayRef = collections.namedtuple('ArrayRef', ['dtype', 'shape', 'offset'])
+
+
+class ShmRing(object):
+    """
+    A single producer, single consumer ring of slots in shared memory.
+
+    The reader only ever wants the latest values, older slots are simply
+    overwritten. A slot is valid when the sequence numbers written before
+    and after its payload match the ring's latest sequence number.
+    """
+
+    def __init__(self, name=None, slots=4, slot_size=SLOT_SIZE, untrack=False):
+        self.slots = slots
+        self.slot_size = slot_size
+        size = RING_HEADER.size + slots * (SLOT_HEADER.size + slot_size)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            RING_HEADER.pack_into(self.shm.buf, 0, -1)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            if untrack:
+                # the block belongs to the process that created it, a process
+                # with a resource tracker of its own must not unlink it on exit
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+            self.owner = False
+        self.seq = -1
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def slot_offset(self, seq):
+        return RING_HEADER.size + (seq % self.slots) * (SLOT_HEADER.size + self.slot_size)
+
+    def write(self, values):
+        """ values: a tuple or list of numpy arrays and small picklable objects """
+        description = []
+        arrays = []
+        nbytes = 0
+        for val in values:
+            if isinstance(val, np.ndarray):
+                arr = np.ascontiguousarray(val)
+                description.append(ArrayRef(arr.dtype.str, arr.shape, nbytes))
+                arrays.append(arr)
+                nbytes += arr.nbytes
+            else:
+                description.append(val)
+        meta = pickle.dumps((type(values) is tuple, description), protocol=pickle.HIGHEST_PROTOCOL)
+        if len(meta) + nbytes > self.slot_size:
+            raise ValueError('{} bytes of values exceed the {} bytes of a ring slot, pass a larger slot_size'
+                             .format(len(meta) + nbytes, self.slot_size))
+
+        self.seq += 1
+        buf = self.shm.buf
+        offset = self.slot_offset(self.seq)
+        payload = offset + SLOT_HEADER.size
+        SLOT_HEADER.pack_into(buf, offset, self.seq, -1, len(meta), nbytes)
+        buf[payload:payload + len(meta)] = meta
+        pos = payload + len(meta)
+        for arr in arrays:
+            buf[pos:pos + arr.nbytes] = arr.reshape(-1).view(np.uint8)
+            pos += arr.nbytes
+        SLOT_HEADER.pack_into(buf, offset, self.seq, self.seq, len(meta), nbytes)
+        RING_HEADER.pack_into(buf, 0, self.seq)
+
+    def latest_seq(self):
+        """ sequence number of the latest complete slot, -1 before the first write """
+        return RING_HEADER.unpack_from(self.shm.buf, 0)[0]
+
+    def read_latest(self):
+        """ (sequence number, values) of the latest slot, (-1, None) before the first write """
+        buf = self.shm.buf
+        seq = self.latest_seq()
+        if seq < 0:
+            return -1, None
+
+        offset = self.slot_offset(seq)
+        payload = offset + SLOT_HEADER.size
+        _, end_seq, meta_len, _ = SLOT_HEADER.unpack_from(buf, offset)
+        try:
+            is_tuple, description = pickle.loads(buf[payload:payload + meta_len])
+            values = []
+            for val in description:
+                if isinstance(val, ArrayRef):
+                    val = np.frombuffer(buf, dtype=val.dtype, count=int(np.prod(val.shape)),
+                                        offset=payload + meta_len + val.offset).reshape(val.shape).copy()
+                values.append(val)
+        except Exception:
+            # a torn description, caught by the sequence numbers below
+            values = None
+
+        start_seq = SLOT_HEADER.unpack_from(buf, offset)[0]
+        if values is None or start_seq != seq or end_seq != seq:
+            # overwritten while copying, the reader is a whole ring behind
+            return -1, None
+        return seq, tuple(values) if is_tuple else values
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _serve(part, input_name, output_name, slots, slot_size, untrack, input_ready, stop):
+    """ Runs in the part's process: run the part on the latest inputs until stopped. """
+    inputs = ShmRing(input_name, slots, slot_size, untrack)
+    outputs = ShmRing(output_name, slots, slot_size, untrack)
+    last_seq = -1
+    try:
+        while not stop.is_set():
+            if not input_ready.acquire(timeout=0.1):
+                continue
+            seq, values = inputs.read_latest()
+            if seq <= last_seq:
+                continue
+            last_seq = seq
+
+            result = part.run(*values)
+            if result is not None:
+                # a part with one output returns the value itself
+                outputs.write(result if type(result) is tuple else [result])
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        logger.exception('Part {} failed in its process'.format(part.__class__.__name__))
+        raise
+    finally:
+        try:
+            part.shutdown()
+        except Exception as e:
+            logger.debug(e)
+        inputs.close()
+        outputs.close()
+
+
+class ProcessPart(object):
+    """
+    Runs a part in a child process, see Vehicle.add(process=True).
+
+    run() hands the inputs of the current loop to the process and returns
+    the latest outputs the part produced, which, like the outputs of a
+    threaded part, may come from an earlier loop. It returns None until
+    the first outputs arrive. The same output objects are returned until
+    the part produces new ones, so the versions of the output channels
+    only change with the outputs.
+    """
+
+    def __init__(self, part, slots=4, slot_size=SLOT_SIZE):
+        self.part = part
+        self.slots = slots
+        self.slot_size = slot_size
+        self.inputs = None
+        self.outputs = None
+        self.process = None
+        self.input_ready = None
+        self.stop = None
+        # (sequence number, return value of run) of the outputs read last
+        self.latest = (-1, None)
+
+    def start(self):
+        self.inputs = ShmRing(slots=self.slots, slot_size=self.slot_size)
+        self.outputs = ShmRing(slots=self.slots, slot_size=self.slot_size)
+        self.input_ready = multiprocessing.Semaphore(0)
+        self.stop = multiprocessing.Event()
+        self.process = multiprocessing.Process(
+            target=_serve, name=self.part.__class__.__name__, daemon=True,
+            args=(self.part, self.inputs.name, self.outputs.name, self.slots, self.slot_size,
+                  # a forked process shares the resource tracker of the vehicle
+                  multiprocessing.get_start_method() != 'fork', self.input_ready, self.stop))
+        self.process.start()
+        logger.info('Started part {} in process {}'.format(self.part.__class__.__name__, self.process.pid))
+
+    def run(self, *args):
+        if not self.process.is_alive():
+            raise RuntimeError('The process of part {} exited with code {}'.format(
+                self.part.__class__.__name__, self.process.exitcode))
+
+        self.inputs.write(args)
+        self.input_ready.release()
+
+        if self.outputs.latest_seq() == self.latest[0]:
+            return self.latest[1]
+        seq, values = self.outputs.read_latest()
+        if seq < 0:
+            # nothing written yet, or overwritten while reading
+            return self.latest[1]
+        self.latest = (seq, values if type(values) is tuple else values[0])
+        return self.latest[1]
+
+    def shutdown(self, timeout=2.0):
+        if self.process is None:
+            return
+        self.stop.set()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            logger.warning('Part {} did not stop in {}s, terminating it'.format(
+                self.part.__class__.__name__, timeout))
+            self.process.terminate()
+            self.process.join()
+        self.inputs.close()
+        self.outputs.close()
+        self.process = None
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+profiler.py
+
+Timing statistics of the drive loop and of the parts it runs.
+
+Durations go into histograms with fixed, logarithmically spaced buckets,
+so recording one is a bisect and an increment and the memory used does not
+grow with the number of loops.
+"""
+import bisect
+import collections
+import math
+
+import numpy as np
+
+from log import get_logger
+
+logger = get_logger(__name__)
+
+# bucket upper bounds in seconds, 8 per octave (~9% wide) from 10us to ~20s
+BUCKETS_PER_OCTAVE = 8
+BUCKET_BOUNDS = [1e-5 * 2 ** (i / BUCKETS_PER_OCTAVE) for i in range(21 * BUCKETS_PER_OCTAVE)]
+
+
+class LatencyHistogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """ The p-th percentile in seconds, to the middle of its bucket. """
+        if not self.count:
+            return 0.0
+        rank = math.ceil(self.count * p / 100.0)
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                if i == len(BUCKET_BOUNDS):
+                    return self.max
+                return min(BUCKET_BOUNDS[i] * 2 ** (-0.5 / BUCKETS_PER_OCTAVE), self.max)
+        return self.max
+
+    def summary(self):
+        """ count and mean, p50, p90, p99 and max in ms """
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count,
+                'mean': self.total / self.count * 1000,
+                'p50': self.percentile(50) * 1000,
+                'p90': self.percentile(90) * 1000,
+                'p99': self.percentile(99) * 1000,
+                'max': self.max * 1000}
+
+
+class RecentLatencies(object):
+    """
+    The latencies of the last `history` calls of a pilot, kept as they are
+    for exact percentiles of its recent behaviour.
+    """
+
+    def __init__(self, history=1000):
+        self.values = collections.deque(maxlen=history)
+
+    def __len__(self):
+        return len(self.values)
+
+    def record(self, seconds):
+        self.values.append(seconds)
+
+    def clear(self):
+        self.values.clear()
+
+    def percentiles(self, percentiles=(50, 90, 99)):
+        """ {percentile: latency in ms} """
+        if not self.values:
+            return {}
+        values = np.percentile(np.array(self.values) * 1000, percentiles)
+        return dict(zip(percentiles, values))
+
+    def log(self, name='Pilot'):
+        latencies = self.percentiles()
+        if latencies:
+            logger.info(name + ' latency ' + ', '.join('p{}: {:.1f}ms'.format(p, v) for p, v in latencies.items()))
+
+
+class VehicleProfiler(object):
+    """
+    Collects the run time of each part and, per loop, the loop period, the
+    time spent running parts, the jitter of the period and the overruns of
+    the loop budget.
+    """
+
+    def __init__(self):
+        self.parts = {}
+        self.skipped = {}
+        self.period = LatencyHistogram()
+        self.busy = LatencyHistogram()
+        self.jitter = LatencyHistogram()
+        self.overruns = 0
+        self.missed = 0
+        self.degraded_loops = 0
+        self.loops = 0
+        self.rate_hz = None
+
+    def record_part(self, name, seconds):
+        hist = self.parts.get(name)
+        if hist is None:
+            hist = self.parts[name] = LatencyHistogram()
+        hist.record(seconds)
+
+    def record_skip(self, name):
+        """ a run of the part left out because its inputs had not changed """
+        self.skipped[name] = self.skipped.get(name, 0) + 1
+
+    def record_loop(self, busy, period=None):
+        """
+        busy: time spent running the parts in this loop
+        period: time since the start of the previous loop, None for the first
+        """
+        self.loops += 1
+        self.busy.record(busy)
+        budget = 1.0 / self.rate_hz if self.rate_hz else None
+        if budget is not None and busy > budget:
+            self.overruns += 1
+        if period is not None:
+            self.period.record(period)
+            if budget is not None:
+                self.jitter.record(abs(period - budget))
+
+    def record_missed(self, ticks):
+        """ ticks of the loop schedule that were dropped """
+        self.missed += ticks
+
+    def stats(self):
+        return {'loops': self.loops,
+                'rate_hz': self.rate_hz,
+                'overruns': self.overruns,
+                'missed': self.missed,
+                'degraded_loops': self.degraded_loops,
+                'period': self.period.summary(),
+                'busy': self.busy.summary(),
+                'jitter': self.jitter.summary(),
+                'parts': {name: dict(self.parts[name].summary() if name in self.parts else {'count': 0},
+                                     skipped=self.skipped.get(name, 0))
+                          for name in set(self.parts) | set(self.skipped)}}
+
+    def summary(self):
+        """ One line for the log, with the parts taking the most time first. """
+        period = self.period.summary()
+        if not period['count']:
+            return 'no loops timed yet'
+        line = 'loops: {}, period p50/p99: {:.1f}/{:.1f}ms, jitter p99: {:.1f}ms, overruns: {}, missed: {}'.format(
+            self.loops, period['p50'], period['p99'], self.jitter.summary().get('p99', 0.0), self.overruns,
+            self.missed)
+        parts = sorted(self.parts.items(), key=lambda item: item[1].total, reverse=True)
+        return line + ' | ' + ', '.join('{} p50/p99: {:.2f}/{:.2f}ms'.format(
+            name, hist.percentile(50) * 1000, hist.percentile(99) * 1000) for name, hist in parts)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Replay a synthetic load trace through the drive loop once per missed tick
+policy and report the timing the loop achieved.
+
+Usage:
+    python replay_loop.py [--hz 20] [--loops 400] [--seed 0]
+
+The trace stands in for a real car: a fast control part, a pilot that
+usually fits in the loop but spikes now and then, a tub writer at half
+the loop rate and a 1Hz telemetry part. The last two are not critical.
+Every policy replays the same trace, so the results compare directly.
+"""
+import argparse
+import random
+import time
+
+from vehicle import Vehicle, MISSED_TICK_POLICIES
+
+
+class ReplayLoad(object):
+    """ A part that takes the next duration of its trace every time it runs. """
+
+    def __init__(self, durations):
+        self.durations = durations
+        self.pos = 0
+        self.runs = 0
+
+    def run(self, *args):
+        time.sleep(self.durations[self.pos % len(self.durations)])
+        self.pos += 1
+        self.runs += 1
+
+    def shutdown(self):
+        pass
+
+
+def make_trace(loops, seed):
+    rnd = random.Random(seed)
+    pilot = []
+    for _ in range(loops):
+        # 3% of the frames take 3 - 6 loops worth of time
+        pilot.append(rnd.uniform(0.15, 0.3) if rnd.random() < 0.03 else rnd.uniform(0.015, 0.025))
+    return {'control': [rnd.uniform(0.002, 0.005) for _ in range(loops)],
+            'pilot': pilot,
+            'tub': [rnd.uniform(0.008, 0.015) for _ in range(loops)],
+            'telemetry': [0.03] * loops}
+
+
+def replay(trace, hz, loops, policy):
+    V = Vehicle(stats_interval=None)
+    parts = {name: ReplayLoad(durations) for name, durations in trace.items()}
+    V.add(parts['control'])
+    V.add(parts['pilot'])
+    V.add(parts['tub'], rate_hz=hz / 2, critical=False)
+    V.add(parts['telemetry'], rate_hz=1, critical=False)
+
+    start = time.perf_counter()
+    V.start(rate_hz=hz, max_loop_count=loops, missed_tick=policy)
+    # start() waits a second for the parts to warm up
+    elapsed = time.perf_counter() - start - 1
+    stats = V.stats()
+    return {'loop_hz': stats['loops'] / elapsed,
+            'control_hz': parts['control'].runs / elapsed,
+            'tub_hz': parts['tub'].runs / elapsed,
+            'period_p50': stats['period']['p50'],
+            'period_p99': stats['period']['p99'],
+            'jitter_p50': stats['jitter']['p50'],
+            'missed': stats['missed'],
+            'degraded': stats['degraded_loops']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hz', type=float, default=20)
+    parser.add_argument('--loops', type=int, default=400)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    trace = make_trace(args.loops, args.seed)
+    results = {policy: replay(trace, args.hz, args.loops, policy) for policy in MISSED_TICK_POLICIES}
+
+    print('{} loops at {}Hz'.format(args.loops, args.hz))
+    print('{:<10} {:>8} {:>10} {:>8} {:>11} {:>11} {:>11} {:>7} {:>9}'.format(
+        'policy', 'loop Hz', 'control Hz', 'tub Hz', 'period p50', 'period p99', 'jitter p50', 'missed',
+        'degraded'))
+    for policy, r in results.items():
+        print('{:<10} {:>8.2f} {:>10.2f} {:>8.2f} {:>9.1f}ms {:>9.1f}ms {:>9.2f}ms {:>7} {:>9}'.format(
+            policy, r['loop_hz'], r['control_hz'], r['tub_hz'], r['period_p50'], r['period_p99'],
+            r['jitter_p50'], r['missed'], r['degraded']))
+
+
+if __name__ == '__main__':
+    main()
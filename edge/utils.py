@@ -20,13 +20,13 @@ def scale(im, size=128):
     return im
 
 
-def img_to_binary(img):
+def img_to_binary(img, quality=75):
     """
-    accepts: PIL image
+    accepts: PIL image, jpeg quality from 1 to 95
     returns: binary stream (used to save to database)
     """
     f = io.BytesIO()
-    img.save(f, format='jpeg')
+    img.save(f, format='jpeg', quality=quality)
     return f.getvalue()
 
 
@@ -7,35 +7,85 @@ Created on Sun December 21 10:44:24 2020
 """
 
 from builtins import bool
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import inspect
 from threading import Thread
 import time
 
 from log import get_logger
-from memory import Memory
+from memory import Memory, split_history_key
+from profiler import VehicleProfiler
 
 
 logger = get_logger(__name__)
 
+# what the drive loop does when the parts overran the start of the next loop
+SKIP = 'skip'  # run the late loop now, drop the loops whose tick has fully passed
+CATCH_UP = 'catch_up'  # run the missed loops back to back
+DEGRADE = 'degrade'  # catch up running only the critical parts
+MISSED_TICK_POLICIES = (SKIP, CATCH_UP, DEGRADE)
+
+# loops a late vehicle runs back to back at most before dropping the rest
+MAX_CATCH_UP = 5
+
+# with run_async, a plain part running longer than BLOCKING_RUN seconds in
+# BLOCKING_RUNS of its runs moves from the event loop to the executor
+BLOCKING_RUN = 0.002
+BLOCKING_RUNS = 3
+
 
 class Vehicle:
-    def __init__(self, mem=None):
+    def __init__(self, mem=None, stats_interval=60, workers=0):
+        """
+        stats_interval: seconds between the timing summaries written to the
+        log, None to not log them. Vehicle.stats() is always available.
+        workers: threads running independent parts of a loop concurrently,
+        0 runs the parts one after the other in the order they were added.
+        """
         if not mem:
             mem = Memory()
         self.mem = mem
         self.parts = []
         self.on = True
+        self.profiler = VehicleProfiler()
+        self.tick = 0
+        self.degraded = False
+        self.stats_interval = stats_interval
+        self.workers = workers
+        self.pool = None
+        self.waves = None
+        self.loop_count = 0
+        self.last_start = None
+        self.last_log = self.deadline = None
         # self.threads = []
 
     def add(self, part, inputs=[], outputs=[],
-            threaded=False, run_condition=None):
+            threaded=False, run_condition=None, rate_hz=None, divisor=None, critical=True,
+            process=False, only_on_change=False):
         """
         Method to add a part to the vehicle drive loop.
         Parameters
         ----------
+                :param divisor: int
+                Run the part every divisor-th loop only.
+                :param rate_hz: float
+                Run the part at about this rate instead of every loop, it is
+                turned into a divisor of the loop rate when the vehicle starts.
+                :param critical: boolean
+                False if the part may be left out of loops that are behind
+                schedule, with the 'degrade' missed tick policy.
+                :param only_on_change: boolean
+                Skip the part in loops where none of its inputs got a new
+                value since it last ran. Memory.version tells.
                 :param run_condition: boolean
                 If a part should be run at all.
                 :param threaded: boolean
                 If a part should be run in a separate thread.
+                :param process: boolean
+                If a part should run in its own process. Its inputs and
+                outputs go through shared memory and, like with a threaded
+                part, the outputs may be those of an earlier loop.
                 :param outputs: list
                 Channel names to save to memory.
                 :param inputs: list
@@ -45,14 +95,42 @@ class Vehicle:
         assert type(inputs) is list, "inputs is not a list: %r" % inputs
         assert type(outputs) is list, "outputs is not a list: %r" % outputs
         assert type(threaded) is bool, "threaded is not a boolean: %r" % threaded
+        assert not (threaded and process), "a part can't be both threaded and run in a process"
+        assert inputs or not only_on_change, "a part without inputs never sees them change"
+        assert rate_hz is None or divisor is None, "pass either rate_hz or divisor"
+        assert divisor is None or (type(divisor) is int and divisor >= 1), \
+            "divisor is not a positive int: %r" % divisor
 
         p = part
         logger.info('Adding part {}.'.format(p.__class__.__name__))
         entry = dict()
+        entry['name'] = self.part_name(p)
+        if process:
+            # the loop runs the proxy, the part itself runs in the process.
+            # shared_memory needs python 3.8, imported only by the vehicles using it
+            from process_part import ProcessPart
+            p = ProcessPart(part)
+            entry['process'] = p
         entry['part'] = p
         entry['inputs'] = inputs
         entry['outputs'] = outputs
         entry['run_condition'] = run_condition
+        entry['rate_hz'] = rate_hz
+        entry['divisor'] = divisor or 1
+        entry['phase'] = 0
+        entry['critical'] = critical
+        # reading the history of a channel depends on its writer like reading the channel
+        entry['reads'] = {split_history_key(k)[0] for k in inputs} | ({run_condition} if run_condition else set())
+        # the channels resolved to memory slots once instead of every loop
+        entry['get_inputs'] = self.mem.getter(inputs)
+        entry['put_outputs'] = self.mem.setter(outputs)
+        entry['get_run_condition'] = self.mem.reader(run_condition) if run_condition else None
+        entry['get_versions'] = self.mem.version_getter(inputs) if only_on_change else None
+        entry['seen_versions'] = None
+        entry['coroutine'] = inspect.iscoroutinefunction(p.run_threaded if threaded else p.run)
+        entry['offload'] = False
+        entry['blocking_runs'] = 0
+        self.check_dependencies(entry)
 
         if threaded:
             t = Thread(target=part.update, args=())
@@ -60,7 +138,119 @@ class Vehicle:
             entry['thread'] = t
         self.parts.append(entry)
 
-    def start(self, rate_hz=10, max_loop_count=None):
+    def check_dependencies(self, entry):
+        """
+        A channel written by two parts or parts depending on their own
+        outputs through other parts make the result depend on the order the
+        parts run in. That's how the sequential loop always ran, but parts
+        running concurrently need an unambiguous data flow, so with workers
+        these raise a ValueError. Otherwise they are logged.
+        """
+        problem = None
+        for other in self.parts:
+            shared = set(entry['outputs']) & set(other['outputs'])
+            if shared:
+                problem = 'Part {} writes {} which {} writes as well'.format(
+                    entry['name'], sorted(shared), other['name'])
+                break
+        else:
+            cycle = self.find_cycle(self.parts + [entry], entry)
+            if cycle:
+                problem = 'Parts depend on their own outputs: {}'.format(' -> '.join(e['name'] for e in cycle))
+
+        if problem is None:
+            return
+        if self.workers:
+            raise ValueError(problem)
+        logger.warning(problem + ', they run in the order they were added')
+
+    @staticmethod
+    def find_cycle(entries, start):
+        """ A path of parts from start back to start along written -> read channels, or None """
+        path = [start]
+
+        def visit(entry, seen):
+            for other in entries:
+                if other is entry or not set(entry['outputs']) & other['reads']:
+                    continue
+                if other is start:
+                    return True
+                if id(other) in seen:
+                    continue
+                seen.add(id(other))
+                path.append(other)
+                if visit(other, seen):
+                    return True
+                path.pop()
+            return False
+
+        return path + [start] if visit(start, set()) else None
+
+    def plan_waves(self):
+        """
+        Group the parts into waves that run one after the other, the parts of
+        a wave concurrently. A part runs in a later wave than every part
+        added before it that writes a channel it reads, reads a channel it
+        writes or writes the same channel, so memory ends up the same as
+        with the sequential loop.
+        """
+        levels = []
+        for i, entry in enumerate(self.parts):
+            level = 0
+            for j in range(i):
+                other = self.parts[j]
+                if set(other['outputs']) & entry['reads'] or \
+                        other['reads'] & set(entry['outputs']) or \
+                        set(other['outputs']) & set(entry['outputs']):
+                    level = max(level, levels[j] + 1)
+            levels.append(level)
+
+        waves = [[] for _ in range(max(levels, default=-1) + 1)]
+        for entry, level in zip(self.parts, levels):
+            waves[level].append(entry)
+        return waves
+
+    def part_name(self, part):
+        """ The class name of the part, numbered if the vehicle has several """
+        name = part.__class__.__name__
+        names = [entry['name'] for entry in self.parts]
+        if name not in names:
+            return name
+        num = 2
+        while '{}_{}'.format(name, num) in names:
+            num += 1
+        return '{}_{}'.format(name, num)
+
+    def schedule(self, rate_hz):
+        """
+        Turn the rate_hz of the parts into divisors of the loop rate and
+        spread the parts sharing a divisor over its ticks, so they don't all
+        run in the same loop. Which part runs in which loop only depends on
+        the loop count.
+        """
+        sharing = {}
+        for entry in self.parts:
+            if entry['rate_hz']:
+                entry['divisor'] = max(1, int(round(rate_hz / entry['rate_hz'])))
+                actual = rate_hz / entry['divisor']
+                if abs(actual - entry['rate_hz']) > 0.01 * entry['rate_hz']:
+                    logger.info('Part {} runs at {:.2f}Hz instead of {}Hz, every {} loops'
+                                .format(entry['name'], actual, entry['rate_hz'], entry['divisor']))
+            divisor = entry['divisor']
+            entry['phase'] = sharing.get(divisor, 0) % divisor
+            sharing[divisor] = sharing.get(divisor, 0) + 1
+
+    def stats(self):
+        """
+        Timing of the drive loop: loop count, overruns of the 1 / rate_hz
+        budget, dropped and degraded loops and histogram summaries (ms) of
+        the loop period, the time spent running parts and the jitter of the
+        period. Per part, a summary of its run times and the runs skipped
+        since its inputs had not changed.
+        """
+        return self.profiler.stats()
+
+    def start(self, rate_hz=10, max_loop_count=None, missed_tick=SKIP):
         """
         Start vehicle's main drive loop.
 
@@ -77,7 +267,18 @@ class Vehicle:
         max_loop_count : int
             Maxiumum number of loops the drive loop should execute. This is
             used for testing the all the parts of the vehicle work.
+        missed_tick : str
+            What to do when the parts run past the start of the next loop,
+            one of MISSED_TICK_POLICIES.
+
+        Loops start on a fixed schedule of absolute deadlines from the
+        monotonic clock, so an overrun doesn't shift the following loops
+        and wall clock adjustments don't affect the timing.
         """
+        assert missed_tick in MISSED_TICK_POLICIES, "unknown missed tick policy: %r" % missed_tick
+        coroutines = [entry['name'] for entry in self.parts if entry['coroutine']]
+        if coroutines:
+            raise ValueError('Parts {} are coroutines, drive the vehicle with run_async'.format(coroutines))
 
         try:
             self.on = True
@@ -86,59 +287,258 @@ class Vehicle:
                 if entry.get('thread'):
                     # start the update thread
                     entry.get('thread').start()
+                if entry.get('process'):
+                    entry.get('process').start()
 
             # wait until the parts warm up.
             logger.info('Starting vehicle...')
             time.sleep(1)
 
-            loop_count = 0
-            while self.on:
-                start_time = time.time()
-                loop_count += 1
+            period = 1.0 / rate_hz
+            if self.workers:
+                self.waves = self.plan_waves()
+                self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='vehicle')
+                logger.info('Running {} parts in {} waves on {} workers'.format(
+                    len(self.parts), len(self.waves), self.workers))
 
+            self.begin_loops(rate_hz)
+            while self.on:
+                start_time = time.perf_counter()
                 self.update_parts()
+                now = time.perf_counter()
+                deadline = self.end_loop(start_time, now, period, missed_tick, max_loop_count)
+                if deadline > now:
+                    time.sleep(deadline - now)
+
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
 
-                # stop drive loop if loop_count exceeds max_loopcount
-                if max_loop_count and loop_count > max_loop_count:
-                    self.on = False
+    def run_async(self, rate_hz=10, max_loop_count=None, missed_tick=SKIP):
+        """
+        Start the drive loop as a task of an asyncio event loop, with the
+        parameters of start, and block until it ends.
 
-                sleep_time = 1.0 / rate_hz - (time.time() - start_time)
-                if sleep_time > 0.0:
-                    time.sleep(sleep_time)
+        Parts whose run (run_threaded for threaded parts) is a coroutine
+        function are awaited by the loop, so the parts doing I/O share the
+        event loop instead of needing threads. A threaded part with an
+        update_async coroutine, like the web controller, runs it as a task
+        on the same event loop instead of running update in a thread.
 
+        Plain parts run on the event loop thread as with start, until they
+        block it: a part taking longer than BLOCKING_RUN in BLOCKING_RUNS
+        runs is moved to a thread of the executor from then on.
+        """
+        try:
+            asyncio.run(self.drive_async(rate_hz, max_loop_count, missed_tick))
         except KeyboardInterrupt:
             pass
         finally:
             self.stop()
 
+    async def drive_async(self, rate_hz=10, max_loop_count=None, missed_tick=SKIP):
+        """ The drive loop of run_async, for callers running their own event loop. """
+        assert missed_tick in MISSED_TICK_POLICIES, "unknown missed tick policy: %r" % missed_tick
+        self.on = True
+        tasks = []
+        for entry in self.parts:
+            update_async = getattr(entry['part'], 'update_async', None)
+            if entry.get('thread') and update_async is not None:
+                tasks.append(asyncio.ensure_future(update_async()))
+            elif entry.get('thread'):
+                entry.get('thread').start()
+            if entry.get('process'):
+                entry.get('process').start()
+
+        logger.info('Starting vehicle...')
+        await asyncio.sleep(1)
+
+        period = 1.0 / rate_hz
+        self.pool = ThreadPoolExecutor(max_workers=max(1, self.workers), thread_name_prefix='vehicle')
+        if self.workers:
+            self.waves = self.plan_waves()
+            logger.info('Running {} parts in {} waves on the event loop and {} workers'.format(
+                len(self.parts), len(self.waves), self.workers))
+
+        self.begin_loops(rate_hz)
+        try:
+            while self.on:
+                start_time = time.perf_counter()
+                await self.update_parts_async()
+                now = time.perf_counter()
+                deadline = self.end_loop(start_time, now, period, missed_tick, max_loop_count)
+                # sleep even when late, so the tasks sharing the event loop get to run
+                await asyncio.sleep(max(0.0, deadline - now))
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def begin_loops(self, rate_hz):
+        self.profiler.rate_hz = rate_hz
+        self.schedule(rate_hz)
+        self.tick = 0
+        self.degraded = False
+        self.loop_count = 0
+        self.last_start = None
+        self.last_log = self.deadline = time.perf_counter()
+
+    def end_loop(self, start_time, now, period, missed_tick, max_loop_count):
+        """
+        Account for a loop that ran the parts from start_time to now and
+        return the start of the next one.
+        """
+        self.loop_count += 1
+        self.profiler.record_loop(now - start_time,
+                                  start_time - self.last_start if self.last_start is not None else None)
+        self.last_start = start_time
+        if self.stats_interval and start_time - self.last_log >= self.stats_interval:
+            logger.info('Drive loop ' + self.profiler.summary())
+            self.last_log = start_time
+
+        # stop drive loop if loop_count exceeds max_loopcount
+        if max_loop_count and self.loop_count > max_loop_count:
+            self.on = False
+
+        self.deadline = self.next_deadline(self.deadline + period, now, period, missed_tick)
+        return self.deadline
+
+    def next_deadline(self, deadline, now, period, missed_tick):
+        """
+        The start of the next loop, given its scheduled start and the time
+        the current loop finished.
+        """
+        self.degraded = False
+        if now <= deadline:
+            return deadline
+
+        behind = int((now - deadline) // period)
+        if missed_tick == SKIP:
+            # the late loop starts right away, only the ticks fully passed are dropped
+            if behind:
+                self.profiler.record_missed(behind)
+            return deadline + behind * period
+
+        self.degraded = missed_tick == DEGRADE
+        if behind >= MAX_CATCH_UP:
+            # too far behind to ever catch up, restart the schedule
+            self.profiler.record_missed(behind)
+            return deadline + behind * period
+        return deadline
+
     def update_parts(self):
         """
-        loop over all parts
+        loop over all parts due in this loop
         """
-        for entry in self.parts:
-            run = True
-            if entry.get('run_condition'):
-                # don't run if there is a run condition that is False
-                run_condition = entry.get('run_condition')
-                run = self.mem.get([run_condition])[0]
-
-            if run:
-                p = entry['part']
-                #get inputs from memory
-                inputs = self.mem.get(entry['inputs'])
-
-                #run the part
-                if entry.get('thread'):
-                    outputs = p.run_threaded(*inputs)
-                else:
-                    outputs = p.run(*inputs)
+        if self.degraded:
+            self.profiler.degraded_loops += 1
+        tick = self.tick
+        self.tick += 1
+        if self.pool is None:
+            for entry in self.parts:
+                self.run_part(entry, tick)
+            return
+
+        for wave in self.waves:
+            if len(wave) == 1:
+                self.run_part(wave[0], tick)
+            else:
+                # result() raises the exception of a failed part
+                for future in [self.pool.submit(self.run_part, entry, tick) for entry in wave]:
+                    future.result()
+
+    async def update_parts_async(self):
+        """ update_parts of run_async """
+        if self.degraded:
+            self.profiler.degraded_loops += 1
+        tick = self.tick
+        self.tick += 1
+        if self.waves is None:
+            for entry in self.parts:
+                await self.run_part_async(entry, tick)
+            return
+
+        for wave in self.waves:
+            if len(wave) == 1:
+                await self.run_part_async(wave[0], tick)
+            else:
+                await asyncio.gather(*(self.run_part_async(entry, tick) for entry in wave))
+
+    def due(self, entry, tick):
+        """ If the part runs in this loop, counting the runs skipped as its inputs had not changed """
+        if tick % entry['divisor'] != entry['phase']:
+            return False
+        if self.degraded and not entry['critical']:
+            return False
+
+        # don't run if there is a run condition that is False
+        get_run_condition = entry['get_run_condition']
+        if get_run_condition is not None and not get_run_condition():
+            return False
+
+        get_versions = entry['get_versions']
+        if get_versions is not None:
+            versions = get_versions()
+            if versions == entry['seen_versions']:
+                self.profiler.record_skip(entry['name'])
+                return False
+            entry['seen_versions'] = versions
+        return True
+
+    def run_part(self, entry, tick):
+        if not self.due(entry, tick):
+            return
+
+        start = time.perf_counter()
+        #get inputs from memory
+        inputs = entry['get_inputs']()
+
+        #run the part
+        outputs = self.call_part(entry, inputs)
+
+        #save the output to memory
+        if outputs is not None:
+            entry['put_outputs'](outputs)
+
+        self.profiler.record_part(entry['name'], time.perf_counter() - start)
+
+    async def run_part_async(self, entry, tick):
+        if not self.due(entry, tick):
+            return
+
+        start = time.perf_counter()
+        inputs = entry['get_inputs']()
+        if entry['coroutine']:
+            outputs = await self.call_part(entry, inputs)
+        elif entry['offload']:
+            outputs = await asyncio.get_running_loop().run_in_executor(self.pool, self.call_part, entry, inputs)
+        else:
+            outputs = self.call_part(entry, inputs)
+
+        if outputs is not None:
+            entry['put_outputs'](outputs)
+
+        seconds = time.perf_counter() - start
+        self.profiler.record_part(entry['name'], seconds)
+        if seconds > BLOCKING_RUN and not (entry['coroutine'] or entry['offload']):
+            entry['blocking_runs'] += 1
+            if entry['blocking_runs'] >= BLOCKING_RUNS:
+                entry['offload'] = True
+                logger.info('Part {} blocks the event loop for {:.1f}ms, running it in the executor'
+                            .format(entry['name'], seconds * 1000))
 
-                #save the output to memory
-                if outputs is not None:
-                    self.mem.put(entry['outputs'], outputs)
+    @staticmethod
+    def call_part(entry, inputs):
+        if entry.get('thread'):
+            return entry['part'].run_threaded(*inputs)
+        return entry['part'].run(*inputs)
 
     def stop(self):
         logger.info('Shutting down vehicle and its parts...')
+        logger.info('Drive loop ' + self.profiler.summary())
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
         for entry in self.parts:
             try:
                 entry['part'].shutdown()